@@ -0,0 +1,201 @@
+"""_summary_
+    Benchmarks for the money lender blockchain hot paths.
+    Synthetic chains are built through MoneyLenderBlockChain and every hot path is timed on each chain size,
+    the results are written as json and can be compared against a saved baseline to catch regressions.
+
+    python benchmark_ledger.py --sizes 1000,10000 --output bench.json
+    python benchmark_ledger.py --sizes 1000,10000 --compare bench.json --threshold 0.25
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# the app reads its configuration when it is created, keep its ledger out of the working directory and its miner idle
+os.environ.setdefault("MONEY_LENDER_CHAIN_LOG", os.path.join(tempfile.mkdtemp(), "bench_chain.log"))
+os.environ.setdefault("MONEY_LENDER_MINE_THRESHOLD", str(2 ** 31))
+os.environ.setdefault("MONEY_LENDER_MINE_INTERVAL", str(10 ** 9))
+
+import money_lender_app
+from money_lender_blockchain import MoneyLenderBlockChain
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_DIFFICULTIES = [1, 2, 3, 4]
+
+# the fewest calls a benchmark needs in both runs before --compare judges it
+MIN_COMPARE_REPEAT = 20
+
+# accounts verified by the full validation benchmark on each chain size, its repeat count is scaled down to it,
+# 200 calls on 10k accounts, 20 on 100k and 2 on 1M, so a large chain is not verified from genesis `repeat` times
+FULL_VALIDATION_BUDGET = 2000000
+
+
+@contextlib.contextmanager
+def quiet():
+    # the chain prints on every mined account and request
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def measure(operation, repeat, setup=None):
+    # time `operation` `repeat` times, `setup` runs untimed before each call
+    timings = []
+    for i in range(repeat):
+        argument = setup(i) if setup is not None else i
+        start = time.perf_counter()
+        operation(argument)
+        timings.append(time.perf_counter() - start)
+
+    return {
+            "repeat": repeat,
+            "meanMicroseconds": statistics.mean(timings) * 1e6,
+            "medianMicroseconds": statistics.median(timings) * 1e6,
+            "minMicroseconds": min(timings) * 1e6,
+            "opsPerSecond": repeat / sum(timings) if sum(timings) > 0 else None
+        }
+
+
+def build_chain(size, lenders=100):
+    # a chain of `size` accounts, every account carries a transfer from the mining owner to one of the lenders
+    chain = MoneyLenderBlockChain()
+    chain.miningDifficulty = 0
+    chain.maxAmountMinable = 10 ** 9
+    with quiet(), money_lender_app.money_lender_app.app_context():
+        while len(chain.AccountChain) < size:
+            chain.create_new_lending_request(chain.miningOutputOwner, "lender%d" % (len(chain.AccountChain) % lenders), 1)
+            chain.process_pending_requests()
+    return chain
+
+
+def bench_chain(size, repeat, difficulties):
+    results = {}
+    started = time.perf_counter()
+    chain = build_chain(size)
+    results["build_chain"] = {"seconds": time.perf_counter() - started}
+
+    app = money_lender_app.create_app()
+    money_lender_app.money_lender_blockchain = chain
+    money_lender_app.mining_scheduler.blockchain = chain
+
+    with quiet(), app.app_context():
+        results["calculate_lender_balance"] = measure(lambda i: chain.calculate_lender_balance("lender%d" % (i % 100)), repeat)
+        results["create_new_lending_request"] = measure(
+            lambda i: chain.create_new_lending_request(chain.miningOutputOwner, "borrower%d" % i, 1), repeat)
+
+        # a fresh group per call, each lender funds a quarter of it
+        def new_group(i):
+            chain.create_lender_group("bench-group%d" % i, 4, 0.25)
+            return i
+        results["add_lender_to_group"] = measure(
+            lambda i: chain.add_lender_to_group("lender%d" % (i % 100), "bench-group%d" % i), repeat, new_group)
+
+        # full verification from genesis, then the incremental check after one more account
+        def full_validation(i):
+            chain.verifiedHeight = 0
+            chain.is_the_blockchain_valid()
+        results["is_the_blockchain_valid_full"] = measure(full_validation, max(1, min(repeat, FULL_VALIDATION_BUDGET // size)))
+
+        def new_account(i):
+            chain.process_pending_requests()
+        results["is_the_blockchain_valid_incremental"] = measure(lambda i: chain.is_the_blockchain_valid(), repeat, new_account)
+
+        for difficulty in difficulties:
+            def pending_pool(i):
+                chain.miningDifficulty = difficulty
+                for n in range(10):
+                    chain.create_new_lending_request(chain.miningOutputOwner, "pool%d-%d-%d" % (difficulty, i, n), 1)
+            results["process_pending_requests_difficulty_%d" % difficulty] = measure(
+                lambda i: chain.process_pending_requests(), repeat, pending_pool)
+        chain.miningDifficulty = 0
+
+    client = app.test_client()
+    with quiet():
+        endpoints = {
+                "GET /lender/balance": lambda i: client.get("/lender/balance?lender=lender%d" % (i % 100)),
+                "GET /pending_requests": lambda i: client.get("/pending_requests"),
+                "GET /accounts?limit=100": lambda i: client.get("/accounts?cursor=%d&limit=100" % (i % len(chain.AccountChain))).get_data(),
+                "GET /health": lambda i: client.get("/health"),
+                "POST /create_lending_requests/": lambda i: client.post(
+                    "/create_lending_requests/?lender=%s&borrower=client%d&amount=1" % (chain.miningOutputOwner, i)),
+            }
+        for name, operation in endpoints.items():
+            results[name] = measure(operation, repeat)
+
+    chain.close()
+    return results
+
+
+def compare(results, baseline, threshold, minRepeat=MIN_COMPARE_REPEAT):
+    # the benchmarks whose median and minimum times both grew by more than `threshold` over the baseline,
+    # the mean follows the outliers of a busy machine, and benchmarks timed fewer than `minRepeat` times are not judged
+    regressions = []
+    for size, benchmarks in results["results"].items():
+        for name, result in benchmarks.items():
+            previous = baseline.get("results", {}).get(size, {}).get(name)
+            if previous is None or "medianMicroseconds" not in result or "medianMicroseconds" not in previous:
+                continue
+            if min(result["repeat"], previous["repeat"]) < minRepeat:
+                continue
+            change = result["medianMicroseconds"] / previous["medianMicroseconds"] - 1
+            minChange = result["minMicroseconds"] / previous["minMicroseconds"] - 1
+            if change > threshold and minChange > threshold:
+                regressions.append({"size": size, "benchmark": name, "change": change,
+                                    "baselineMicroseconds": previous["medianMicroseconds"],
+                                    "currentMicroseconds": result["medianMicroseconds"]})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the money lender blockchain hot paths")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="comma separated chain sizes")
+    parser.add_argument("--difficulties", default=",".join(str(d) for d in DEFAULT_DIFFICULTIES),
+                        help="comma separated mining difficulties for process_pending_requests")
+    parser.add_argument("--repeat", type=int, default=200,
+                        help="calls per benchmark, the full validation from genesis is scaled down on the large chains")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--compare", help="baseline json file to compare the results against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slow down of the median and minimum times over the baseline, 0.25 is 25%%")
+    args = parser.parse_args(argv)
+
+    results = {
+            "meta": {
+                    "date": datetime.now().isoformat(),
+                    "python": sys.version,
+                    "platform": platform.platform(),
+                    "cpus": os.cpu_count()
+                },
+            "results": {}
+        }
+    for size in [int(size) for size in args.sizes.split(",")]:
+        print("benchmarking a chain of %d accounts" % size, file=sys.stderr)
+        results["results"][str(size)] = bench_chain(size, args.repeat, [int(d) for d in args.difficulties.split(",")])
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print("REGRESSION %(benchmark)s on %(size)s accounts: median %(baselineMicroseconds).1fus -> %(currentMicroseconds).1fus"
+                  % regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
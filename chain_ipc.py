@@ -0,0 +1,203 @@
+"""_summary_
+    Local IPC between the process that owns the money lender blockchain and the api worker processes.
+    The chain owner runs the Flask app next to the one MoneyLenderBlockChain, the workers forward every http request
+    over a multiprocessing connection and stream the response back, each connection is served on its own thread
+    so a slow request never holds up the others.
+
+    python chain_ipc.py --address 127.0.0.1:5050
+
+    The messages are pickles, so the owner only listens on the loopback or a unix socket and both sides prove they
+    hold the same secret: MONEY_LENDER_IPC_KEY, or a random key the chain owner writes to a file only its user can read.
+"""
+
+import argparse
+import io
+import ipaddress
+import os
+import queue
+import secrets
+import sys
+import threading
+from multiprocessing.connection import Listener, Client
+
+DEFAULT_ADDRESS = "127.0.0.1:5050"
+DEFAULT_KEY_PATH = "money_lender_ipc.key"
+
+# body bytes the chain owner gathers before it sends them on, a small response goes over in one message
+SEND_BUFFER = 64 * 1024
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host.strip("[]")).is_loopback
+    except ValueError:
+        return False
+
+
+def parse_address(address):
+    # host:port for a tcp socket on the loopback, anything else is a unix socket path
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit():
+        if not is_loopback(host):
+            raise ValueError("The chain owner only listens on the loopback, not on %s" % host)
+        return host.strip("[]"), int(port)
+    return address
+
+
+def ipc_authkey(create=False):
+    # the secret shared by the chain owner and its workers, the chain owner creates the key file when there is none
+    key = os.environ.get("MONEY_LENDER_IPC_KEY")
+    if key:
+        return key.encode()
+
+    path = os.environ.get("MONEY_LENDER_IPC_KEY_FILE", DEFAULT_KEY_PATH)
+    if create and not os.path.exists(path):
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(descriptor, 'w') as file:
+            file.write(secrets.token_hex(32))
+    if not os.path.exists(path):
+        raise ValueError("No IPC key, set MONEY_LENDER_IPC_KEY or start the chain owner first to create %s" % path)
+    with open(path) as file:
+        return file.read().strip().encode()
+
+
+def wsgi_events(app, environ, body):
+    # run a wsgi app and yield ("start", status, headers) then ("body", data) for every chunk of the response
+    environ = dict(environ)
+    environ["wsgi.input"] = io.BytesIO(body)
+    environ["wsgi.errors"] = sys.stderr
+
+    response = {}
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name, value) for name, value in headers]
+        return written.append
+
+    iterable = app(environ, start_response)
+    try:
+        started = False
+        for data in iterable:
+            if not started:
+                yield ("start", response["status"], response["headers"])
+                started = True
+            if written:
+                yield ("body", b''.join(written))
+                written.clear()
+            if data:
+                yield ("body", data)
+        if not started:
+            yield ("start", response["status"], response["headers"])
+        if written:
+            yield ("body", b''.join(written))
+    finally:
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+
+class ChainOwner:
+    def __init__(self, app, address=DEFAULT_ADDRESS, authkey=None):
+        self.app = app
+        self.address = parse_address(address)
+        self.authkey = authkey or ipc_authkey(create=True)
+        self.listener = None
+
+    def serve_forever(self):
+        self.listener = Listener(self.address, authkey=self.authkey)
+        print("\n Chain owner listening on %s \n" % (self.listener.address,))
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                if self.listener is None:
+                    return
+                continue
+            threading.Thread(target=self.serve_connection, args=(connection,), name="chain-owner", daemon=True).start()
+
+    def close(self):
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.close()
+
+    def serve_connection(self, connection):
+        # one request at a time per connection, the worker keeps a pool of connections
+        # the events are sent in batches, many small sends on a tcp socket stall on the delayed acknowledgements
+        with connection:
+            while True:
+                try:
+                    environ, body = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    batch = []
+                    size = 0
+                    for event in wsgi_events(self.app, environ, body):
+                        batch.append(event)
+                        if event[0] == "body":
+                            size += len(event[1])
+                        if size >= SEND_BUFFER:
+                            connection.send(batch)
+                            batch = []
+                            size = 0
+                    batch.append(("end",))
+                    connection.send(batch)
+                except (EOFError, OSError):
+                    return
+
+
+class ChainClient:
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        self.address = parse_address(address)
+        self.authkey = authkey or ipc_authkey()
+
+        # idle connections to the chain owner, a request takes one and gives it back when its response is read
+        self.connections = queue.LifoQueue()
+
+    def connect(self):
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            return Client(self.address, authkey=self.authkey)
+
+    def http(self, environ, body):
+        # the same events as wsgi_events, read from the chain owner
+        connection = self.connect()
+        finished = False
+        try:
+            connection.send((environ, body))
+            while True:
+                for event in connection.recv():
+                    if event[0] == "end":
+                        finished = True
+                        return
+                    yield event
+        finally:
+            # a response abandoned half way leaves the connection out of step, it is not reused
+            if finished:
+                self.connections.put(connection)
+            else:
+                connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Own the money lender blockchain and serve the api workers over IPC")
+    parser.add_argument("--address", default=os.environ.get("MONEY_LENDER_CHAIN_OWNER", DEFAULT_ADDRESS),
+                        help="host:port on the loopback or a unix socket path")
+    args = parser.parse_args(argv)
+    try:
+        owner = ChainOwner(None, args.address)
+    except ValueError as error:
+        parser.error(str(error))
+
+    # the chain, its log, the mining scheduler and the peer node live in this process only
+    import money_lender_app
+    owner.app = money_lender_app.create_app()
+    money_lender_app.peer_node.start()
+    owner.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
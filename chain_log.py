@@ -0,0 +1,481 @@
+"""_summary_
+    Append only on-disk log for the money lender blockchain.
+    Every record is length prefixed binary, the account blocks use the canonical block encoding.
+    The block log has an offset index next to it so the blocks are memory mapped and decoded lazily on start up,
+    the pending requests and the lending groups are journaled in a small separate file,
+    and a balance snapshot saves re-reading every block to rebuild the balance index.
+"""
+
+import mmap
+import os
+import struct
+import time
+from array import array
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from lending_requests import GroupLenderM, Lender, LendingRequest
+from chain_store import RequestRecord, BlockRecord
+from lending_requests import BLOCK_LAYOUT, REQUEST_LAYOUT, NO_HASH, HASH_VERSION_BATCH, from_epoch_micros, to_epoch_micros
+
+# record types
+RECORD_BLOCK = 1
+RECORD_PENDING_ADD = 2
+RECORD_PENDING_CLEAR = 3
+RECORD_GROUP = 4
+RECORD_PENDING_REMOVE = 5
+RECORD_PENDING_MINED = 6
+
+RECORD_HEADER = struct.Struct('<IB')        # payload length, record type
+BLOCK_RECORD = struct.Struct('<32s32sQ')    # hashState, requestHash, nonce
+GROUP_LAYOUT = struct.Struct('<ddqH')       # totalAmount, splitRate, groupCreationDate, number of lenders
+AMOUNT_LAYOUT = struct.Struct('<d')
+HASH_LAYOUT = struct.Struct('<32s')
+COUNT_LAYOUT = struct.Struct('<I')
+TEXT_LENGTH = struct.Struct('<H')
+OFFSET_LAYOUT = struct.Struct('<Q')
+SNAPSHOT_LAYOUT = struct.Struct('<Q32sI')   # height, hashState at the height, number of balances
+HEIGHT_LAYOUT = struct.Struct('<Q')
+BALANCE_LAYOUT = struct.Struct('<q')
+
+NO_TEXT = 0xFFFF
+
+
+def pack_text(text):
+    if text is None:
+        return TEXT_LENGTH.pack(NO_TEXT)
+    data = text.encode()
+    return TEXT_LENGTH.pack(len(data)) + data
+
+
+def unpack_text(buffer, offset):
+    (length,) = TEXT_LENGTH.unpack_from(buffer, offset)
+    offset += TEXT_LENGTH.size
+    if length == NO_TEXT:
+        return None, offset
+    return buffer[offset:offset + length].decode(), offset + length
+
+
+def decode_request_body(buffer, offset, requestHash):
+    amount, requestDate, lender_length, borrower_length = REQUEST_LAYOUT.unpack_from(buffer, offset)
+    end = offset + REQUEST_LAYOUT.size + lender_length + borrower_length
+    return RequestRecord(requestHash + buffer[offset:end]), end
+
+
+def encode_request(request):
+    return HASH_LAYOUT.pack(bytes.fromhex(request.requestHash)) + LendingRequest(request).encode()
+
+
+def decode_request(buffer, offset):
+    # a journaled or batched request is stored the way RequestRecord keeps it, the hash then the encoding
+    amount, requestDate, lender_length, borrower_length = REQUEST_LAYOUT.unpack_from(buffer, offset + HASH_LAYOUT.size)
+    end = offset + HASH_LAYOUT.size + REQUEST_LAYOUT.size + lender_length + borrower_length
+    return RequestRecord(buffer[offset:end]), end
+
+
+def encode_block(record):
+    # the stored hashes and nonce followed by the canonical block encoding
+    data = BLOCK_RECORD.pack(record.hashState, record.lendingRequest.requestHash, record.nonce)
+    data += BLOCK_LAYOUT.pack(record.hashVersion, record.lastAccount or NO_HASH, record.creationDate)
+
+    # a batched block header only has the merkle root, the mining reward and the batched requests follow it
+    if record.hashVersion >= HASH_VERSION_BATCH:
+        data += record.merkleRoot + record.lendingRequest.encode() + COUNT_LAYOUT.pack(len(record.lendingRequests))
+        data += b''.join(HASH_LAYOUT.pack(request.requestHash) + request.encode() for request in record.lendingRequests)
+    else:
+        data += record.lendingRequest.encode()
+    return data
+
+
+def decode_block(buffer, offset):
+    hashState, requestHash, nonce = BLOCK_RECORD.unpack_from(buffer, offset)
+    offset += BLOCK_RECORD.size
+    hashVersion, lastAccount, creationDate = BLOCK_LAYOUT.unpack_from(buffer, offset)
+    offset += BLOCK_LAYOUT.size
+
+    # the record works the merkle root out from its requests, a stored root that does not match fails the hash state
+    if hashVersion >= HASH_VERSION_BATCH:
+        offset += HASH_LAYOUT.size
+    request, offset = decode_request_body(buffer, offset, requestHash)
+
+    lendingRequests = []
+    if hashVersion >= HASH_VERSION_BATCH:
+        (count,) = COUNT_LAYOUT.unpack_from(buffer, offset)
+        offset += COUNT_LAYOUT.size
+        for i in range(count):
+            batched, offset = decode_request(buffer, offset)
+            lendingRequests.append(batched)
+
+    return BlockRecord(request, tuple(lendingRequests), None if lastAccount == NO_HASH else lastAccount, creationDate,
+                       hashState, nonce, hashVersion)
+
+
+def encode_group(group):
+    payload = GROUP_LAYOUT.pack(group.totalAmount, group.splitRate_inPercent, to_epoch_micros(group.groupCreationDate),
+                                len(group.lenders))
+    payload += pack_text(group.name) + pack_text(group.groupHash)
+    for lender in group.lenders:
+        payload += AMOUNT_LAYOUT.pack(lender.amount) + pack_text(lender.name) + pack_text(lender.proof_of_participation_key)
+
+    # the signed proofs of participation trail the record, groups logged before they existed end at the lenders
+    payload += pack_text(group.publicKey)
+    for lender in group.lenders:
+        payload += pack_text(lender.proof_of_participation_signature)
+    return payload
+
+
+def decode_group(buffer, offset, end):
+    totalAmount, splitRate, groupCreationDate, lender_count = GROUP_LAYOUT.unpack_from(buffer, offset)
+    offset += GROUP_LAYOUT.size
+    name, offset = unpack_text(buffer, offset)
+    groupHash, offset = unpack_text(buffer, offset)
+
+    lenders = []
+    for i in range(lender_count):
+        (amount,) = AMOUNT_LAYOUT.unpack_from(buffer, offset)
+        offset += AMOUNT_LAYOUT.size
+        lender_name, offset = unpack_text(buffer, offset)
+        key, offset = unpack_text(buffer, offset)
+        lenders.append(Lender.construct(name=lender_name, amount=amount, proof_of_participation_key=key,
+                                        proof_of_participation_signature=None))
+
+    publicKey = None
+    if offset < end:
+        publicKey, offset = unpack_text(buffer, offset)
+        for lender in lenders:
+            lender.proof_of_participation_signature, offset = unpack_text(buffer, offset)
+
+    return GroupLenderM.construct(name=name, totalAmount=totalAmount, splitRate_inPercent=splitRate, lenders=lenders,
+                                  groupCreationDate=from_epoch_micros(groupCreationDate), groupHash=groupHash,
+                                  publicKey=publicKey)
+
+
+def frame(record_type, payload):
+    return RECORD_HEADER.pack(len(payload), record_type) + payload
+
+
+def scan_records(buffer, offset, size):
+    # yield (record type, payload offset, record end) for every complete record
+    while offset + RECORD_HEADER.size <= size:
+        length, record_type = RECORD_HEADER.unpack_from(buffer, offset)
+        end = offset + RECORD_HEADER.size + length
+        if end > size:
+            break
+        yield record_type, offset + RECORD_HEADER.size, end
+        offset = end
+
+
+def lock_file(path):
+    # an exclusive lock held as long as the file is open, a second process taking it fails at once
+    file = open(path, 'a+b')
+    try:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        file.close()
+        raise ValueError("The chain log is already open in another process, %s is locked" % path)
+    return file
+
+
+def map_file(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with open(path, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class LoggedBlocks:
+    # the account records on disk, decoded from the memory map on access
+    def __init__(self, buffer=None, offsets=None):
+        self.buffer = buffer
+        self.offsets = offsets if offsets is not None else array('Q')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        return decode_block(self.buffer, self.offsets[index] + RECORD_HEADER.size)
+
+    def __delitem__(self, index):
+        del self.offsets[index]
+
+    def hash_state(self, index):
+        # the stored hash state of a block without decoding it
+        offset = self.offsets[index] + RECORD_HEADER.size
+        return self.buffer[offset:offset + HASH_LAYOUT.size]
+
+
+class ChainLog:
+    def __init__(self, path, fsyncEvery=64, fsyncInterval=1.0):
+        self.path = path
+        self.indexPath = path + '.idx'
+        self.journalPath = path + '.journal'
+        self.snapshotPath = path + '.balances'
+        self.checkpointPath = path + '.checkpoint'
+        self.archivePath = path + '.archive'
+        self.keyPath = path + '.key'
+
+        # one process at a time appends to, truncates and prunes the log
+        self.lockFile = lock_file(path + '.lock')
+
+        # records are flushed on every append, fsync is batched by count and by time
+        self.fsyncEvery = fsyncEvery
+        self.fsyncInterval = fsyncInterval
+        self.unsynced = 0
+        self.lastSync = time.monotonic()
+        self.files = {}
+        self.blocksSize = os.path.getsize(path) if os.path.exists(path) else 0
+
+        # the pending requests mined in the blocks below this height have been journaled as removed
+        self.minedHeight = 0
+
+        # the memory mapped blocks of the last load_blocks
+        self.blocks = None
+
+    def open(self, path):
+        if path not in self.files:
+            self.files[path] = open(path, 'ab')
+        return self.files[path]
+
+    def write(self, path, data):
+        file = self.open(path)
+        file.write(data)
+        file.flush()
+
+    def record_written(self):
+        self.unsynced += 1
+        if self.unsynced >= self.fsyncEvery or time.monotonic() - self.lastSync >= self.fsyncInterval:
+            self.sync()
+
+    def sync(self):
+        if self.unsynced:
+            for file in self.files.values():
+                os.fsync(file.fileno())
+        self.unsynced = 0
+        self.lastSync = time.monotonic()
+
+    def close_files(self):
+        self.sync()
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+    def close(self):
+        self.close_files()
+        self.unmap_blocks()
+        if self.lockFile is not None:
+            self.lockFile.close()
+            self.lockFile = None
+
+    def append_block(self, account):
+        # the block goes first, its offset is only indexed once the block is on disk
+        record = frame(RECORD_BLOCK, encode_block(account))
+        self.write(self.path, record)
+        self.write(self.indexPath, OFFSET_LAYOUT.pack(self.blocksSize))
+        self.blocksSize += len(record)
+        self.record_written()
+
+    def unmap_blocks(self):
+        # Windows does not truncate or replace a file while a view of it is mapped
+        if self.blocks is not None and self.blocks.buffer is not None:
+            self.blocks.buffer.close()
+            self.blocks.buffer = None
+
+    def truncate_blocks(self, height):
+        # drop the blocks from `height` up, counted from the start of the log, the mapped blocks below it are remapped
+        for file in self.files.values():
+            file.flush()
+        with open(self.indexPath, 'rb') as file:
+            file.seek(height * OFFSET_LAYOUT.size)
+            data = file.read(OFFSET_LAYOUT.size)
+        if len(data) < OFFSET_LAYOUT.size:
+            return
+
+        (offset,) = OFFSET_LAYOUT.unpack(data)
+        self.unmap_blocks()
+        self.truncate(self.path, offset)
+        self.truncate(self.indexPath, height * OFFSET_LAYOUT.size)
+        if self.blocks is not None:
+            self.blocks.buffer = map_file(self.path)
+        self.blocksSize = offset
+        self.unsynced += 1
+        self.sync()
+
+    def prune_blocks(self, count, archive=True):
+        # drop the first `count` blocks from the log, the archive keeps them as a block log of their own,
+        # the mapped blocks are released and load_blocks maps the pruned log again
+        with open(self.indexPath, 'rb') as file:
+            offsets = array('Q')
+            data = file.read()
+            offsets.frombytes(data[:len(data) - len(data) % OFFSET_LAYOUT.size])
+        if count <= 0 or count > len(offsets):
+            return
+        self.close_files()
+        self.unmap_blocks()
+
+        cut = offsets[count] if count < len(offsets) else self.blocksSize
+        with open(self.path, 'rb') as source:
+            if archive:
+                with open(self.archivePath, 'ab') as file:
+                    file.write(source.read(cut))
+                    file.flush()
+                    os.fsync(file.fileno())
+            source.seek(cut)
+            with open(self.path + '.tmp', 'wb') as file:
+                file.write(source.read())
+                file.flush()
+                os.fsync(file.fileno())
+
+        # the index is rebuilt from the new log if the node stops before it is rewritten
+        os.remove(self.indexPath)
+        os.replace(self.path + '.tmp', self.path)
+        kept = array('Q', (offset - cut for offset in offsets[count:]))
+        with open(self.indexPath + '.tmp', 'wb') as file:
+            file.write(kept.tobytes())
+        os.replace(self.indexPath + '.tmp', self.indexPath)
+        self.blocksSize -= cut
+
+    def append_journal(self, record_type, payload):
+        self.write(self.journalPath, frame(record_type, payload))
+        self.record_written()
+
+    def append_pending(self, request):
+        self.append_journal(RECORD_PENDING_ADD, encode_request(request))
+
+    def append_pending_many(self, requests):
+        # a bulk load is written and counted for fsync as a single record
+        if len(requests) > 0:
+            self.write(self.journalPath, b''.join(frame(RECORD_PENDING_ADD, encode_request(request)) for request in requests))
+            self.record_written()
+
+    def remove_pending(self, requestHashes, height):
+        # `height` is the chain height the removal is journaled at, a restart only looks for mined requests above it
+        self.append_journal(RECORD_PENDING_MINED, HEIGHT_LAYOUT.pack(height)
+                            + b''.join(bytes.fromhex(requestHash) for requestHash in requestHashes))
+        self.minedHeight = height
+
+    def append_group(self, group):
+        self.append_journal(RECORD_GROUP, encode_group(group))
+
+    def load_blocks(self):
+        buffer = map_file(self.path)
+        if buffer is None:
+            self.truncate(self.path, 0)
+            self.truncate(self.indexPath, 0)
+            self.blocks = LoggedBlocks()
+            return self.blocks
+
+        offsets = array('Q')
+        index = map_file(self.indexPath)
+        if index is not None:
+            offsets.frombytes(index[:len(index) - len(index) % OFFSET_LAYOUT.size])
+            index.close()
+
+        # drop offsets of blocks torn by a crash, then index the blocks written after the last indexed offset
+        size = len(buffer)
+        while len(offsets) and not self.complete_record(buffer, offsets[-1], size):
+            offsets.pop()
+        start = 0
+        if len(offsets):
+            start = offsets[-1] + RECORD_HEADER.size + RECORD_HEADER.unpack_from(buffer, offsets[-1])[0]
+            
+        end = start
+        for record_type, payload_offset, end in scan_records(buffer, start, size):
+            offsets.append(payload_offset - RECORD_HEADER.size)
+
+        if end < size:
+            buffer.close()
+            self.truncate(self.path, end)
+            buffer = map_file(self.path)
+        self.blocksSize = end
+        with open(self.indexPath, 'wb') as file:
+            file.write(offsets.tobytes())
+
+        self.blocks = LoggedBlocks(buffer, offsets)
+        return self.blocks
+
+    @staticmethod
+    def complete_record(buffer, offset, size):
+        if offset + RECORD_HEADER.size > size:
+            return False
+        return offset + RECORD_HEADER.size + RECORD_HEADER.unpack_from(buffer, offset)[0] <= size
+
+    @staticmethod
+    def truncate(path, size):
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, 'r+b') as file:
+                file.truncate(size)
+
+    def replay_journal(self):
+        # rebuild the pending requests and the lending groups, the latest record of a group wins
+        pending = []
+        groups = {}
+        records = 0
+        buffer = map_file(self.journalPath)
+        if buffer is not None:
+            end = 0
+            for record_type, offset, end in scan_records(buffer, 0, len(buffer)):
+                records += 1
+                if record_type == RECORD_PENDING_ADD:
+                    pending.append(decode_request(buffer, offset)[0].to_model())
+                elif record_type == RECORD_PENDING_CLEAR:
+                    pending = []
+                elif record_type in (RECORD_PENDING_REMOVE, RECORD_PENDING_MINED):
+                    # journals written before the mined height only have the hashes
+                    if record_type == RECORD_PENDING_MINED:
+                        (self.minedHeight,) = HEIGHT_LAYOUT.unpack_from(buffer, offset)
+                        offset += HEIGHT_LAYOUT.size
+                    removed = set(buffer[i:i + HASH_LAYOUT.size].hex() for i in range(offset, end, HASH_LAYOUT.size))
+                    pending = [request for request in pending if request.requestHash not in removed]
+                elif record_type == RECORD_GROUP:
+                    group = decode_group(buffer, offset, end)
+                    groups[group.name] = group
+            buffer.close()
+
+        # rewrite the journal with only the live state when it has grown past it
+        groups = list(groups.values())
+        if records > len(pending) + len(groups) + (1 if self.minedHeight > 0 else 0):
+            self.compact_journal(pending, groups)
+
+        return pending, groups
+
+    def compact_journal(self, pending, groups):
+        records = [frame(RECORD_PENDING_MINED, HEIGHT_LAYOUT.pack(self.minedHeight))] if self.minedHeight > 0 else []
+        records += [frame(RECORD_PENDING_ADD, encode_request(request)) for request in pending]
+        records += [frame(RECORD_GROUP, encode_group(group)) for group in groups]
+        with open(self.journalPath + '.tmp', 'wb') as file:
+            file.write(b''.join(records))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.journalPath + '.tmp', self.journalPath)
+
+    def save_balances(self, height, hashState, balances):
+        payload = SNAPSHOT_LAYOUT.pack(height, bytes.fromhex(hashState), len(balances))
+        payload += b''.join(pack_text(name) + BALANCE_LAYOUT.pack(amount) for name, amount in balances.items())
+        with open(self.snapshotPath + '.tmp', 'wb') as file:
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.snapshotPath + '.tmp', self.snapshotPath)
+
+    def load_balances(self):
+        # returns (height, hashState, balances) or None when there is no snapshot
+        if not os.path.exists(self.snapshotPath):
+            return None
+        with open(self.snapshotPath, 'rb') as file:
+            buffer = file.read()
+        height, hashState, count = SNAPSHOT_LAYOUT.unpack_from(buffer, 0)
+        offset = SNAPSHOT_LAYOUT.size
+        balances = {}
+        for i in range(count):
+            name, offset = unpack_text(buffer, offset)
+            (balances[name],) = BALANCE_LAYOUT.unpack_from(buffer, offset)
+            offset += BALANCE_LAYOUT.size
+        return height, hashState.hex(), balances
@@ -0,0 +1,221 @@
+"""_summary_
+    Compact storage for the account chain.
+    Every account block is kept as a __slots__ record with integer amounts, epoch microsecond timestamps
+    and raw 32 byte hashes, each request is a single bytes object holding its hash and its canonical encoding
+    and the merkle root is worked out from the request hashes rather than stored,
+    the pydantic models are only built at the API boundary.
+"""
+
+import struct
+from hashlib import sha256
+
+from lending_requests import AccountM, LendingRequestM, Account
+from lending_requests import BLOCK_LAYOUT, REQUEST_LAYOUT, NONCE_LAYOUT, NO_HASH, HASH_VERSION_LEGACY, HASH_VERSION_BATCH
+from lending_requests import to_epoch_micros, from_epoch_micros
+from merkle import merkle_root
+
+
+def optional_bytes(hashState):
+    if hashState is None:
+        return None
+    return bytes.fromhex(hashState)
+
+
+def optional_hex(raw):
+    if raw is None:
+        return None
+    return raw.hex()
+
+
+# the request hash followed by the fixed header of the canonical request encoding
+REQUEST_RECORD = struct.Struct('<32s' + REQUEST_LAYOUT.format.lstrip('<'))
+
+
+class RequestRecord(bytes):
+    # the request hash and the canonical request encoding in one bytes object, the fields are read from it,
+    # a request without a hash (legacy accounts) stores NO_HASH
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, lender, borrower, amount, requestDate, requestHash):
+        lender = (lender or '').encode()
+        borrower = borrower.encode()
+        return cls(REQUEST_RECORD.pack(requestHash or NO_HASH, amount, requestDate, len(lender), len(borrower))
+                   + lender + borrower)
+
+    @classmethod
+    def from_model(cls, request):
+        return cls.create(request.lender, request.borrower, int(request.amount), to_epoch_micros(request.requestDate),
+                          optional_bytes(request.requestHash))
+
+    @property
+    def requestHash(self):
+        requestHash = self[:32]
+        return None if requestHash == NO_HASH else requestHash
+
+    @property
+    def amount(self):
+        return REQUEST_RECORD.unpack_from(self)[1]
+
+    @property
+    def requestDate(self):
+        return REQUEST_RECORD.unpack_from(self)[2]
+
+    @property
+    def lender(self):
+        lender_length = REQUEST_RECORD.unpack_from(self)[3]
+        return self[REQUEST_RECORD.size:REQUEST_RECORD.size + lender_length].decode() or None
+
+    @property
+    def borrower(self):
+        requestHash, amount, requestDate, lender_length, borrower_length = REQUEST_RECORD.unpack_from(self)
+        return self[REQUEST_RECORD.size + lender_length:].decode()
+
+    def to_model(self):
+        return LendingRequestM.construct(lender=self.lender, borrower=self.borrower, amount=self.amount,
+                                         requestDate=from_epoch_micros(self.requestDate),
+                                         requestHash=optional_hex(self.requestHash))
+
+    def encode(self):
+        # same canonical encoding as LendingRequest.encode
+        return self[32:]
+
+
+class BlockRecord:
+    __slots__ = ('lendingRequest', 'lendingRequests', 'lastAccount', 'creationDate', 'hashState', 'nonce',
+                 'hashVersion')
+
+    def __init__(self, lendingRequest, lendingRequests, lastAccount, creationDate, hashState, nonce, hashVersion):
+        self.lendingRequest = lendingRequest
+        self.lendingRequests = lendingRequests
+        self.lastAccount = lastAccount
+        self.creationDate = creationDate
+        self.hashState = hashState
+        self.nonce = nonce
+        self.hashVersion = hashVersion
+
+    @property
+    def merkleRoot(self):
+        # a block with only the mining reward has the reward hash as its root
+        if self.hashVersion < HASH_VERSION_BATCH:
+            return None
+        if not self.lendingRequests:
+            return self.lendingRequest.requestHash
+        return merkle_root([request.requestHash for request in self.all_requests()])
+
+    @classmethod
+    def from_model(cls, account):
+        return cls(RequestRecord.from_model(account.lendingRequest),
+                   tuple(RequestRecord.from_model(request) for request in account.lendingRequests),
+                   optional_bytes(account.lastAccount), to_epoch_micros(account.creationDate),
+                   optional_bytes(account.hashState), account.nonce, account.hashVersion)
+
+    def to_model(self):
+        return AccountM.construct(lendingRequest=self.lendingRequest.to_model(),
+                                  lendingRequests=[request.to_model() for request in self.lendingRequests],
+                                  lastAccount=optional_hex(self.lastAccount),
+                                  creationDate=from_epoch_micros(self.creationDate),
+                                  hashState=optional_hex(self.hashState), nonce=self.nonce,
+                                  hashVersion=self.hashVersion, merkleRoot=optional_hex(self.merkleRoot))
+
+    def all_requests(self):
+        # the mining reward comes first, then the batched requests
+        return (self.lendingRequest,) + self.lendingRequests
+
+    def hash_prefix(self):
+        # same canonical encoding as Account.encode, legacy accounts hash the str() of their models
+        if self.hashVersion == HASH_VERSION_LEGACY:
+            return Account(self.to_model()).hash_prefix()
+        header = BLOCK_LAYOUT.pack(self.hashVersion, self.lastAccount or NO_HASH, self.creationDate)
+        if self.hashVersion >= HASH_VERSION_BATCH:
+            return header + self.merkleRoot
+        return header + self.lendingRequest.encode()
+
+    def calculate_hash_state(self):
+        if self.hashVersion == HASH_VERSION_LEGACY:
+            return bytes.fromhex(Account(self.to_model()).calculate_hash_state())
+        return sha256(self.hash_prefix() + NONCE_LAYOUT.pack(self.nonce)).digest()
+
+    def are_requests_valid(self):
+        # the request hashes must match the batched requests and no request may appear twice
+        # (see Account.are_requests_valid), the merkle root is built from these hashes so the hash state covers it
+        if self.hashVersion < HASH_VERSION_BATCH:
+            return True
+        requests = self.all_requests()
+        for request in requests:
+            if request.requestHash != sha256(request.encode()).digest():
+                return False
+        return len(set(request.requestHash for request in requests)) == len(requests)
+
+
+class CompactChain:
+    # list like account chain, indexing and iterating return the pydantic models,
+    # record() and records() give the compact records to the chain internals
+    def __init__(self, stored=None, base=0):
+        # records memory mapped from the on-disk log, decoded on access
+        self.stored = stored if stored is not None else []
+        self.blocks = []
+
+        # the accounts below the base height have been pruned, the first record is the account at the base height
+        self.base = base
+
+    def __len__(self):
+        return self.base + len(self.stored) + len(self.blocks)
+
+    def record(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("account index out of range")
+        if index < self.base:
+            raise IndexError("account %d has been pruned" % index)
+        index -= self.base
+        if index < len(self.stored):
+            return self.stored[index]
+        return self.blocks[index - len(self.stored)]
+
+    def records(self, start=0, end=None):
+        end = len(self) if end is None else min(end, len(self))
+        for index in range(max(start, self.base), end):
+            yield self.record(index)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.record(i).to_model() for i in range(*index.indices(len(self)))]
+        return self.record(index).to_model()
+
+    def __iter__(self):
+        for record in self.records():
+            yield record.to_model()
+
+    def append(self, account):
+        if not isinstance(account, BlockRecord):
+            account = BlockRecord.from_model(account)
+
+        # the link to the previous account shares the bytes of its hash state
+        if len(self) > 0 and account.lastAccount == self.record(-1).hashState:
+            account.lastAccount = self.record(-1).hashState
+        self.blocks.append(account)
+        return account
+
+    def truncate(self, height):
+        # drop the accounts from `height` up
+        height -= self.base
+        if height < len(self.stored):
+            del self.stored[height:]
+            self.blocks = []
+        else:
+            del self.blocks[height - len(self.stored):]
+
+    def prune(self, base):
+        # drop the accounts below the base height
+        count = base - self.base
+        if count <= 0:
+            return
+        stored = min(count, len(self.stored))
+        del self.stored[:stored]
+        del self.blocks[:count - stored]
+        self.base = base
+
+    def tip_hash(self):
+        return self.record(-1).hashState.hex()
@@ -0,0 +1,55 @@
+"""_summary_
+    Verification of the account records.
+    The hash states are recomputed on a pool of processes, each worker checks a contiguous range of accounts
+    and the first bad height across all the ranges is reported.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+def first_bad_hash(start, accounts):
+    # height of the first account whose stored hash state does not match its recomputed hash state,
+    # or whose batched requests do not match its merkle root
+    for offset, account in enumerate(accounts):
+        if account.hashState != account.calculate_hash_state() or not account.are_requests_valid():
+            return start + offset
+    return None
+
+
+def first_bad_link(accounts, start=0, previous=None):
+    # height of the first account that does not follow the account before it
+    for offset, account in enumerate(accounts):
+        if previous is not None:
+            # compare hashes between the last account and the current account
+            if previous.hashState != account.lastAccount:
+                return start + offset
+
+            # latest accounts should have the most recent creation date
+            if account.creationDate < previous.creationDate:
+                return start + offset
+        previous = account
+    return None
+
+
+def audit_accounts(accounts, workers=None, chunkSize=2048, start=0):
+    # returns the first bad height of the accounts starting at height `start`, or None when they are all valid
+    accounts = list(accounts)
+    bad_heights = []
+
+    bad_link = first_bad_link(accounts, start)
+    if bad_link is not None:
+        bad_heights.append(bad_link)
+
+    workers = workers or os.cpu_count() or 1
+    ranges = [(start + offset, accounts[offset:offset + chunkSize]) for offset in range(0, len(accounts), chunkSize)]
+    if workers <= 1 or len(ranges) <= 1:
+        results = [first_bad_hash(start, chunk) for start, chunk in ranges]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(first_bad_hash, *zip(*ranges)))
+
+    bad_heights += [height for height in results if height is not None]
+    if len(bad_heights) == 0:
+        return None
+    return min(bad_heights)
@@ -0,0 +1,132 @@
+"""_summary_
+    Signed checkpoints of the money lender blockchain.
+    A checkpoint records the chain height, the hash state and creation date of the account at its tip and the balance
+    of every party at that height, signed with the node key. The accounts below the tip can then be pruned,
+    new accounts are verified against the tip and the balances start from the checkpoint instead of the genesis account.
+"""
+
+import os
+import struct
+from hashlib import sha256
+
+import rsa
+
+from chain_log import pack_text, unpack_text, BALANCE_LAYOUT
+
+CHECKPOINT_LAYOUT = struct.Struct('<Q32sqI')    # height, tip hashState, tip creationDate, number of balances
+
+# the checkpoints are the trust anchor of the pruned balances, their key must not be one that can be factored
+NODE_KEY_BITS = 2048
+
+
+class Checkpoint:
+    def __init__(self, height, tipHash, tipCreationDate, balances, signature=None, publicKey=None):
+        self.height = height
+        self.tipHash = tipHash
+        self.tipCreationDate = tipCreationDate
+        self.balances = balances
+        self.signature = signature
+        self.publicKey = publicKey
+
+    @property
+    def base(self):
+        # the tip is the oldest account kept once the chain is pruned
+        return self.height - 1
+
+    def encode_body(self):
+        # the signed part, balances in name order so the encoding is canonical
+        payload = CHECKPOINT_LAYOUT.pack(self.height, self.tipHash, self.tipCreationDate, len(self.balances))
+        payload += b''.join(pack_text(name) + BALANCE_LAYOUT.pack(amount) for name, amount in sorted(self.balances.items()))
+        return payload
+
+    def digest(self):
+        return sha256(self.encode_body()).hexdigest()
+
+    def sign(self, private_key, public_key):
+        self.signature = rsa.sign(self.encode_body(), private_key, 'SHA-256')
+        self.publicKey = public_key.save_pkcs1().decode()
+        return self
+
+    def verify(self, trusted_key):
+        # the signature is checked with a key the node trusts, never with the public key carried by the checkpoint
+        if self.signature is None or trusted_key is None:
+            return False
+        try:
+            rsa.verify(self.encode_body(), self.signature, trusted_key)
+            return True
+        except (rsa.VerificationError, ValueError):
+            return False
+
+    def encode(self):
+        return self.encode_body() + pack_text(self.signature.hex()) + pack_text(self.publicKey)
+
+    @classmethod
+    def decode(cls, buffer):
+        height, tipHash, tipCreationDate, count = CHECKPOINT_LAYOUT.unpack_from(buffer, 0)
+        offset = CHECKPOINT_LAYOUT.size
+        balances = {}
+        for i in range(count):
+            name, offset = unpack_text(buffer, offset)
+            (balances[name],) = BALANCE_LAYOUT.unpack_from(buffer, offset)
+            offset += BALANCE_LAYOUT.size
+        signature, offset = unpack_text(buffer, offset)
+        publicKey, offset = unpack_text(buffer, offset)
+        return cls(height, tipHash, tipCreationDate, balances, bytes.fromhex(signature), publicKey)
+
+    def to_json(self, trusted_key=None):
+        return {
+                "height": self.height,
+                "tipHash": self.tipHash.hex(),
+                "tipCreationDate": self.tipCreationDate,
+                "parties": len(self.balances),
+                "digest": self.digest(),
+                "signature": self.signature.hex() if self.signature is not None else None,
+                "publicKey": self.publicKey,
+                "valid": self.verify(trusted_key)
+            }
+
+
+def save_checkpoint(path, checkpoint):
+    with open(path + '.tmp', 'wb') as file:
+        file.write(checkpoint.encode())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as file:
+        return Checkpoint.decode(file.read())
+
+
+def load_trusted_key(path):
+    # the public key checkpoints are verified with, read from a public key file or from the node key file
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as file:
+        data = file.read()
+    if b'PRIVATE KEY' in data:
+        private_key = rsa.PrivateKey.load_pkcs1(data)
+        return rsa.PublicKey(private_key.n, private_key.e)
+    return rsa.PublicKey.load_pkcs1(data)
+
+
+def load_or_create_key(path, bits=NODE_KEY_BITS):
+    # the node signing key, kept next to the chain log so the checkpoints of a node stay verifiable across restarts,
+    # a key of its own rather than one of the short keys the key pool makes for the groups
+    if path is not None and os.path.exists(path):
+        with open(path, 'rb') as file:
+            private_key = rsa.PrivateKey.load_pkcs1(file.read())
+        return rsa.PublicKey(private_key.n, private_key.e), private_key
+
+    public_key, private_key = rsa.newkeys(bits)
+    if path is not None:
+        descriptor = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(private_key.save_pkcs1())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+    return public_key, private_key
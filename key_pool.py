@@ -0,0 +1,82 @@
+"""_summary_
+    Pool of pre-generated RSA keypairs for the proof of participation of the lending groups.
+    A background thread keeps the pool filled so a group that becomes fully funded never waits on prime generation,
+    the group is signed once per lender with a key taken from the pool.
+"""
+
+import queue
+import threading
+from functools import lru_cache
+
+import rsa
+
+
+class KeyPool:
+    def __init__(self, size=8, bits=512):
+        self.size = size
+        self.bits = bits
+        self.keys = queue.Queue(maxsize=size)
+        self.thread = None
+        self.stopping = threading.Event()
+
+        # keys generated inline because the pool was empty
+        self.misses = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="key-pool", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopping.is_set():
+            keypair = rsa.newkeys(self.bits)
+            while not self.stopping.is_set():
+                try:
+                    self.keys.put(keypair, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def take(self):
+        # (public key, private key), generated inline only when the pool has run dry
+        try:
+            return self.keys.get_nowait()
+        except queue.Empty:
+            self.misses += 1
+            return rsa.newkeys(self.bits)
+
+    def __len__(self):
+        return self.keys.qsize()
+
+
+def stake_message(groupHash, lender):
+    # what a lender's proof of participation signs: the group, the lender and the amount lent
+    return ("%s|%s|%r" % (groupHash, lender.name.lower(), float(lender.amount))).encode()
+
+
+def sign_stakes(groupHash, lenders, private_key):
+    # one signature per lender, all with the group key
+    return [rsa.sign(stake_message(groupHash, lender), private_key, 'SHA-256').hex() for lender in lenders]
+
+
+@lru_cache(maxsize=4096)
+def load_public_key(publicKey):
+    return rsa.PublicKey.load_pkcs1(publicKey.encode())
+
+
+def verify_stake(groupHash, lender, publicKey):
+    if publicKey is None or lender.proof_of_participation_signature is None:
+        return False
+    try:
+        rsa.verify(stake_message(groupHash, lender), bytes.fromhex(lender.proof_of_participation_signature),
+                   load_public_key(publicKey))
+        return True
+    except (rsa.VerificationError, ValueError):
+        return False
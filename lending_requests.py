@@ -1,9 +1,63 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from hashlib import sha256
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+import struct
+import threading
 import rsa
 
+from merkle import merkle_root
+from key_pool import sign_stakes, verify_stake
+
+# block hash versions, legacy blocks hash the str() of the models, binary blocks hash the canonical encoding
+HASH_VERSION_LEGACY = 1
+HASH_VERSION_BINARY = 2
+HASH_VERSION_BATCH = 3     # the header carries the merkle root of the mining reward and the batched requests
+
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+NO_HASH = bytes(32)
+
+# canonical layouts, all little endian, the nonce is always the trailing field of a block
+REQUEST_LAYOUT = struct.Struct('<qqHH')     # amount, requestDate (epoch microseconds), lender length, borrower length
+BLOCK_LAYOUT = struct.Struct('<B32sq')      # hash version, lastAccount hash, creationDate (epoch microseconds)
+NONCE_LAYOUT = struct.Struct('<Q')
+
+
+def to_epoch_micros(date):
+    if date is None:
+        return 0
+    return (date - EPOCH) // ONE_MICROSECOND
+
+
+def from_epoch_micros(micros):
+    return EPOCH + micros * ONE_MICROSECOND
+
+
+# the date of the last request created in this process
+last_request_date = EPOCH
+request_date_lock = threading.Lock()
+
+
+def next_request_date():
+    # the current time, moved on by a microsecond when the clock has not advanced since the last request,
+    # so identical requests created back to back still get different hashes
+    global last_request_date
+    with request_date_lock:
+        last_request_date = max(datetime.now(), last_request_date + ONE_MICROSECOND)
+        return last_request_date
+
+
+def hash_to_bytes(hashState):
+    if hashState is None:
+        return NO_HASH
+    return bytes.fromhex(hashState)
+
+
+def difficulty_target(difficulty):
+    # a hex hash with `difficulty` leading zeros is a digest no greater than this target
+    return ((1 << (256 - 4 * difficulty)) - 1).to_bytes(32, 'big')
+
 
 class create_request (BaseModel):
     lender: str = "Femi"
@@ -25,33 +79,90 @@ class add_lender (BaseModel):
     lender: str
     group: str
     
+# page through the account blocks by height, json returns an array and ndjson one block per line
+class chain_page (BaseModel):
+    cursor: int = 0
+    limit: Optional[int]
+    format: str = "json"
+    
+class merkle_proof_query (BaseModel):
+    requestHash: str
+    
+# process the pending requests, wait until the mining job has finished or return its id straight away
+class process_query (BaseModel):
+    wait: bool = False
+    
+class mining_job_query (BaseModel):
+    jobId: str
+    
+# sampled stacks of a profiled request, as json or in the collapsed stack format
+class profile_query (BaseModel):
+    profileId: str
+    format: str = "json"
+    
+# the accounts of a lender between two dates, paginated with cursor and limit
+class party_history (BaseModel):
+    lender: str
+    start: Optional[datetime]
+    end: Optional[datetime]
+    cursor: int = 0
+    limit: int = 100
+    
+# the balance of a lender at a date
+class balance_at_query (BaseModel):
+    lender: str
+    at: datetime
+    
+# take a signed checkpoint of the balances, and prune the accounts below it
+class checkpoint_query (BaseModel):
+    prune: bool = True
+    
+# a node announcing itself to this node
+class peer_register (BaseModel):
+    url: str
+    
+# the accounts after the first known hash state of the comma separated locator, most recent first
+class peer_blocks (BaseModel):
+    locator: str = ""
+    limit: int = 500
+    
+# verify the proofs of participation of the comma separated group names, or of every group
+class verify_groups (BaseModel):
+    names: Optional[str]
+    
 
 # Lending request transactions   
 class LendingRequestM(BaseModel):
     lender: str = None
     borrower: str
     amount: int
-    requestDate: Optional[datetime] = datetime.now()
+    requestDate: Optional[datetime] = Field(default_factory=next_request_date)
     requestHash: Optional[str]
     
 class AccountM(BaseModel):
     lendingRequest: LendingRequestM
     lastAccount: str = None
-    creationDate: datetime = datetime.now()   
+    creationDate: datetime = Field(default_factory=datetime.now)
     hashState: Optional[str]
+    nonce: int = 0
+    hashVersion: int = HASH_VERSION_LEGACY
+    lendingRequests: List[LendingRequestM] = []
+    merkleRoot: Optional[str]
     
 class Lender(BaseModel):
     name: str
     amount: float
     proof_of_participation_key: Optional[str]
+    proof_of_participation_signature: Optional[str]
 
 class GroupLenderM(BaseModel):
     name: str
     totalAmount: float
     splitRate_inPercent: float
     lenders: List[Lender] = []
-    groupCreationDate: datetime = datetime.now()
+    groupCreationDate: datetime = Field(default_factory=datetime.now)
     groupHash: Optional[str]
+    publicKey: Optional[str]
 
 class LendingRequest:        
     def __init__(self, lenderRequest: LendingRequestM):
@@ -60,8 +171,14 @@ class LendingRequest:
         self.amount = lenderRequest.amount
         self.requestDate = lenderRequest.requestDate
         
+    def encode(self):
+        # fixed header followed by the utf-8 party names, a mined request has no lender
+        lender = (self.lender or '').encode()
+        borrower = self.borrower.encode()
+        return REQUEST_LAYOUT.pack(self.amount, to_epoch_micros(self.requestDate), len(lender), len(borrower)) + lender + borrower
+        
     def calculate_request_hash(self):
-        return sha256((str(self.lender) + str(self.borrower) + str(self.amount) + str(self.requestDate)).encode()).hexdigest()
+        return sha256(self.encode()).hexdigest()
     
 # blocks  
 class Account:
@@ -69,24 +186,52 @@ class Account:
         self.lendingRequest = account.lendingRequest
         self.lastAccount = account.lastAccount
         self.creationDate = account.creationDate        
-        self.counter = 0
+        self.hashVersion = account.hashVersion
+        self.lendingRequests = account.lendingRequests
+        self.merkleRoot = account.merkleRoot
+        self.counter = account.nonce
         self.hashState = self.calculate_hash_state()
-        self.miningWork()
+        
+    def encode(self):
+        # canonical block encoding without the trailing nonce, a batched block commits to its requests by the merkle root
+        header = BLOCK_LAYOUT.pack(self.hashVersion, hash_to_bytes(self.lastAccount), to_epoch_micros(self.creationDate))
+        if self.hashVersion >= HASH_VERSION_BATCH:
+            return header + hash_to_bytes(self.merkleRoot)
+        return header + LendingRequest(self.lendingRequest).encode()
+    
+    def all_requests(self):
+        # the mining reward comes first, then the batched requests
+        return [self.lendingRequest] + list(self.lendingRequests)
+    
+    def calculate_merkle_root(self):
+        return merkle_root([bytes.fromhex(request.requestHash) for request in self.all_requests()]).hex()
+    
+    def are_requests_valid(self):
+        # the request hashes and the merkle root must match the batched requests, and no request may appear twice:
+        # the odd leaf of a merkle level is paired with itself, so repeating the last requests keeps the same root
+        if self.hashVersion < HASH_VERSION_BATCH:
+            return True
+        requests = self.all_requests()
+        for request in requests:
+            if request.requestHash != LendingRequest(request).calculate_request_hash():
+                return False
+        if len(set(request.requestHash for request in requests)) != len(requests):
+            return False
+        return self.merkleRoot == self.calculate_merkle_root()
+        
+    def hash_prefix(self):
+        # everything hashed except the counter
+        if self.hashVersion == HASH_VERSION_LEGACY:
+            return (str(self.lendingRequest) + str(self.lastAccount) + str(self.creationDate)).encode()
+        return self.encode()
         
     def calculate_hash_state(self):
-        hash_object = sha256((str(self.lendingRequest) + str(self.lastAccount) + str(self.creationDate) + str(self.counter)).encode())
+        if self.hashVersion == HASH_VERSION_LEGACY:
+            hash_object = sha256(self.hash_prefix() + str(self.counter).encode())
+        else:
+            hash_object = sha256(self.hash_prefix() + NONCE_LAYOUT.pack(self.counter))
         return hash_object.hexdigest()
     
-    def miningWork(self, difficulty=3):
-        start_time = datetime.now()
-        while True:
-            if self.hashState[0:difficulty] == ''.join(['0'] * difficulty):
-                print("\n Mining Work Completed in %s seconds" % (datetime.now() - start_time))
-                break
-            else:
-                # increment the counter
-                self.counter += 1
-                self.hashState = self.calculate_hash_state()
                 
                 
 class GroupLender:
@@ -96,6 +241,7 @@ class GroupLender:
         self.totalAmount = groupLender.totalAmount
         self.splitRate = groupLender.splitRate_inPercent
         self.groupCreationDate = datetime.now()
+        self.publicKey = groupLender.publicKey
         
     def calculate_hash(self):
         return sha256((str(self.totalAmount) + str(self.splitRate) + str(self.groupCreationDate)).encode()).hexdigest()
@@ -106,14 +252,18 @@ class GroupLender:
             total_lended += lender.amount
         return total_lended
     
-    def process_lender_stake(self, groupHash):
-        # sign the group and give proof of participation to each lender
-        (public_key, priv_key) = rsa.newkeys(512)  
-        signature = rsa.sign(groupHash.encode(), priv_key, 'SHA-256')
-       
-        # print('verify: ', rsa.verify(self.ash.encode(), signature, public_key))
+    def process_lender_stake(self, groupHash, keyPool=None):
+        # sign the group and give proof of participation to each lender,
+        # the key comes from the pre-generated pool and only its public half is kept
+        (public_key, priv_key) = keyPool.take() if keyPool is not None else rsa.newkeys(512)
+        self.publicKey = public_key.save_pkcs1().decode()
         
-        for lender in self.lenders:
-            lender.proof_of_participation_key = str(public_key)
+        for lender, signature in zip(self.lenders, sign_stakes(groupHash, self.lenders, priv_key)):
+            lender.proof_of_participation_key = self.publicKey
+            lender.proof_of_participation_signature = signature
             
-        return self.lenders
\ No newline at end of file
+        return self.lenders
+    
+    def verify_lender_stake(self, groupHash):
+        # lender name -> whether its proof of participation is a valid signature of the group
+        return {lender.name: verify_stake(groupHash, lender, self.publicKey) for lender in self.lenders}
\ No newline at end of file
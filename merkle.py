@@ -0,0 +1,49 @@
+"""_summary_
+    Merkle tree over the request hashes of a batched account block.
+    The leaves are the raw 32 byte request hashes, an odd node at the end of a level is paired with itself,
+    so the accounts must not repeat a request: [a, b, c] and [a, b, c, c] have the same root.
+"""
+
+from hashlib import sha256
+
+
+def merkle_parent(left, right):
+    return sha256(left + right).digest()
+
+
+def merkle_root(leaves):
+    level = list(leaves)
+    if len(level) == 0:
+        return bytes(32)
+
+    while len(level) > 1:
+        if len(level) % 2 == 1:
+            level.append(level[-1])
+        level = [merkle_parent(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0]
+
+
+def merkle_proof(leaves, index):
+    # the sibling hashes from the leaf up to the root, each with the side the sibling sits on
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        if len(level) % 2 == 1:
+            level.append(level[-1])
+
+        sibling = index ^ 1
+        proof.append((level[sibling], "left" if sibling < index else "right"))
+
+        level = [merkle_parent(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+        index //= 2
+    return proof
+
+
+def verify_merkle_proof(leaf, proof, root):
+    node = leaf
+    for sibling, position in proof:
+        if position == "left":
+            node = merkle_parent(sibling, node)
+        else:
+            node = merkle_parent(node, sibling)
+    return node == root
@@ -0,0 +1,258 @@
+"""_summary_
+    Metrics for the money lender blockchain in the Prometheus text format.
+    Counters, gauges and histograms are kept in a process wide registry and rendered by the /metrics endpoint,
+    a sampling profiler can be attached to single requests to find the hot spots under load.
+"""
+
+import sys
+import threading
+import time
+from collections import Counter as StackCounter, OrderedDict
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, escape_label(value)) for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelNames)
+
+    def header(self):
+        return ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        return self.header() + ["%s%s %s" % (self.name, format_labels(self.labelNames, key), format_value(value))
+                                for key, value in values]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        # a gauge with a function is read when the metrics are rendered
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def value(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def render(self):
+        if self.function is not None:
+            return self.header() + ["%s %s" % (self.name, format_value(self.function()))]
+        with self.lock:
+            values = list(self.values.items())
+        return self.header() + ["%s%s %s" % (self.name, format_labels(self.labelNames, key), format_value(value))
+                                for key, value in values]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+
+        lines = self.header()
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(self.labelNames, key, [("le", format_value(bound))]),
+                                                 cumulative))
+            lines.append("%s_sum%s %s" % (self.name, format_labels(self.labelNames, key), format_value(total)))
+            lines.append("%s_count%s %d" % (self.name, format_labels(self.labelNames, key), cumulative))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        # registering a name twice returns the metric already registered
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), function=None):
+        gauge = self.register(Gauge(name, documentation, labels))
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# mining, one observation per mined account
+MINING_SECONDS = REGISTRY.histogram("money_lender_mining_duration_seconds", "Time spent searching the nonce of an account")
+MINING_NONCES = REGISTRY.histogram("money_lender_mining_nonces_tried", "Nonces tried to mine an account",
+                                   buckets=(1, 10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000))
+MINING_NONCES_TOTAL = REGISTRY.counter("money_lender_mining_nonces_tried_total", "Nonces tried over all mined accounts")
+MINING_HASH_RATE = REGISTRY.gauge("money_lender_mining_hash_rate", "Hashes per second of the last mined account")
+ACCOUNTS_MINED = REGISTRY.counter("money_lender_accounts_mined_total", "Accounts mined")
+
+# chain verification, kind is incremental for the health checks and audit for the full verification
+VALIDATION_SECONDS = REGISTRY.histogram("money_lender_validation_duration_seconds", "Time spent verifying accounts",
+                                        labels=("kind",))
+
+# balance reads, kind is balance for the chain balance and available for the balance less the pending pool
+BALANCE_LOOKUPS = REGISTRY.counter("money_lender_balance_lookups_total", "Lender balance lookups", labels=("kind",))
+
+# http requests, the endpoint is the route rule so the label values stay bounded
+REQUEST_SECONDS = REGISTRY.histogram("money_lender_http_request_duration_seconds", "Latency of the http requests",
+                                     labels=("method", "endpoint", "status"))
+
+
+def record_mining(seconds, tried):
+    MINING_SECONDS.observe(seconds)
+    MINING_NONCES.observe(tried)
+    MINING_NONCES_TOTAL.inc(tried)
+    ACCOUNTS_MINED.inc()
+    if seconds > 0:
+        MINING_HASH_RATE.set(tried / seconds)
+
+
+class SamplingProfiler:
+    # samples the stack of one thread at a fixed interval, the result is in the collapsed stack format
+    # ("outer;inner;leaf count" per line) that flame graph tools read
+    def __init__(self, threadId, interval=0.001):
+        self.threadId = threadId
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = None
+        self.startedAt = None
+        self.seconds = 0.0
+
+    def start(self):
+        self.startedAt = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.seconds = time.perf_counter() - self.startedAt
+        return self
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name, code.co_filename, frame.f_lineno))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return "".join("%s %d\n" % (stack, count) for stack, count in self.stacks.most_common())
+
+    def to_json(self):
+        return {
+                "samples": self.samples,
+                "seconds": self.seconds,
+                "intervalSeconds": self.interval,
+                "stacks": self.collapsed()
+            }
+
+
+class ProfileStore:
+    # the most recent request profiles, looked up by id
+    def __init__(self, maxProfiles=100):
+        self.maxProfiles = maxProfiles
+        self.profiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.nextId = 0
+
+    def add(self, profile):
+        with self.lock:
+            self.nextId += 1
+            profileId = str(self.nextId)
+            self.profiles[profileId] = profile
+            while len(self.profiles) > self.maxProfiles:
+                self.profiles.popitem(last=False)
+        return profileId
+
+    def get(self, profileId):
+        with self.lock:
+            return self.profiles.get(profileId)
@@ -0,0 +1,97 @@
+"""_summary_
+    Proof of work for the account blocks.
+    The nonce space is split across a pool of processes, every worker stops as soon as one of them finds a nonce
+    whose hash state meets the mining difficulty.
+"""
+
+import multiprocessing
+import os
+from datetime import datetime
+from hashlib import sha256
+
+from lending_requests import NONCE_LAYOUT, difficulty_target
+from metrics import record_mining
+
+# set by the pool initializer, shared by all the workers of a pool
+_stop_event = None
+
+
+def _init_worker(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+
+
+def search_nonces(prefix, difficulty, start, step, check_every=2048):
+    # try the nonces start, start + step, start + 2 * step ... until one meets the difficulty
+    # or another worker has found a solution
+    # the constant prefix is hashed once, each attempt copies that state and only feeds the nonce
+    midstate = sha256(prefix)
+    target = difficulty_target(difficulty)
+    pack_nonce = NONCE_LAYOUT.pack
+    nonce = start
+    tried = 0
+    while True:
+        tried += 1
+        hash_object = midstate.copy()
+        hash_object.update(pack_nonce(nonce))
+        if hash_object.digest() <= target:
+            if _stop_event is not None:
+                _stop_event.set()
+            return nonce, tried
+
+        nonce += step
+        if tried % check_every == 0 and _stop_event is not None and _stop_event.is_set():
+            return None, tried
+
+
+class MiningEngine:
+    def __init__(self, workers=None, parallelDifficulty=5):
+        self.workers = workers or os.cpu_count() or 1
+
+        # below this difficulty the pool start up costs more than the search itself
+        self.parallelDifficulty = parallelDifficulty
+        self.pool = None
+        self.stopEvent = None
+
+    def start_pool(self):
+        if self.pool is None:
+            self.stopEvent = multiprocessing.Event()
+            self.pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(self.stopEvent,))
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def mine(self, prefix, difficulty):
+        # returns the winning nonce, its hash state and the number of nonces tried
+        start_time = datetime.now()
+        if self.workers <= 1 or difficulty < self.parallelDifficulty:
+            nonce, tried = search_nonces(prefix, difficulty, 0, 1)
+        else:
+            nonce, tried = self.mine_parallel(prefix, difficulty)
+
+        elapsed = datetime.now() - start_time
+        record_mining(elapsed.total_seconds(), tried)
+        print("\n Mining Work Completed in %s seconds" % elapsed)
+        return nonce, sha256(prefix + NONCE_LAYOUT.pack(nonce)).hexdigest(), tried
+
+    def mine_parallel(self, prefix, difficulty):
+        pool = self.start_pool()
+        self.stopEvent.clear()
+
+        # worker k searches the nonces k, k + workers, k + 2 * workers ...
+        results = [pool.apply_async(search_nonces, (prefix, difficulty, k, self.workers)) for k in range(self.workers)]
+
+        # every worker returns once a solution is found, keep the smallest winning nonce
+        winner = None
+        tried = 0
+        for result in results:
+            nonce, count = result.get()
+            tried += count
+            if nonce is not None and (winner is None or nonce < winner):
+                winner = nonce
+
+        return winner, tried
@@ -0,0 +1,119 @@
+"""_summary_
+    Background mining for the money lender blockchain.
+    Mining jobs are queued and run one at a time on a worker thread, a job is also started automatically
+    when the pending pool reaches a size or when requests have been pending for an interval.
+"""
+
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+
+class MiningJob:
+    def __init__(self, trigger):
+        self.jobId = uuid.uuid4().hex
+        self.trigger = trigger
+        self.status = "queued"
+        self.submittedAt = datetime.now()
+        self.startedAt = None
+        self.finishedAt = None
+        self.accountsMined = 0
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def to_json(self):
+        return {
+                "jobId": self.jobId,
+                "trigger": self.trigger,
+                "status": self.status,
+                "submittedAt": self.submittedAt,
+                "startedAt": self.startedAt,
+                "finishedAt": self.finishedAt,
+                "accountsMined": self.accountsMined,
+                "error": self.error
+            }
+
+
+class MiningScheduler:
+    def __init__(self, blockchain, pendingThreshold=100, interval=60.0, pollInterval=0.5, maxJobs=1000):
+        self.blockchain = blockchain
+
+        # mine automatically once this many requests are pending, or once requests have waited `interval` seconds
+        self.pendingThreshold = pendingThreshold
+        self.interval = interval
+        self.pollInterval = pollInterval
+        self.lastRun = datetime.now()
+
+        # the most recent jobs are kept for the status endpoint
+        self.maxJobs = maxJobs
+        self.jobs = OrderedDict()
+        self.jobsLock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="mining-scheduler", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def register(self, job):
+        with self.jobsLock:
+            self.jobs[job.jobId] = job
+            while len(self.jobs) > self.maxJobs:
+                self.jobs.popitem(last=False)
+        return job
+
+    def submit(self, trigger="request"):
+        job = self.register(MiningJob(trigger))
+        self.queue.put(job)
+        return job
+
+    def get_job(self, jobId):
+        with self.jobsLock:
+            return self.jobs.get(jobId)
+
+    def should_mine(self):
+        pending = len(self.blockchain.pendingRequests)
+        if pending == 0:
+            return False
+        if pending >= self.pendingThreshold:
+            return True
+        return (datetime.now() - self.lastRun).total_seconds() >= self.interval
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                job = self.queue.get(timeout=self.pollInterval)
+            except queue.Empty:
+                if not self.should_mine():
+                    continue
+                job = self.register(MiningJob("scheduled"))
+
+            self.run_job(job)
+
+    def run_job(self, job):
+        job.status = "running"
+        job.startedAt = datetime.now()
+        try:
+            job.accountsMined = len(self.blockchain.process_pending_requests())
+            job.status = "done"
+        except Exception as error:
+            job.status = "failed"
+            job.error = str(error)
+        finally:
+            job.finishedAt = datetime.now()
+            self.lastRun = job.finishedAt
+            job.done.set()
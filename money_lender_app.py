@@ -4,11 +4,25 @@
     The group determines how much each person lends out, when they money is complete, they get a proof of participation key.
 """
 
-from flask import jsonify
+import argparse
+import atexit
+import os
+import struct
+import threading
+import time
+
+from flask import jsonify, json, Response, stream_with_context, g
+from flask import request as http_request
 from flask_openapi3 import Info, OpenAPI
+from pydantic import ValidationError
 
 from money_lender_blockchain import MoneyLenderBlockChain
-from lending_requests import create_request, balance, create_group, add_lender
+from mining_scheduler import MiningScheduler
+from lending_requests import create_request, balance, create_group, add_lender, chain_page, merkle_proof_query
+from lending_requests import process_query, mining_job_query, verify_groups, profile_query, peer_register, peer_blocks
+from lending_requests import party_history, balance_at_query, checkpoint_query
+from peers import PeerNode, encode_blocks, BINARY_MIMETYPE
+from metrics import REGISTRY, REQUEST_SECONDS, SamplingProfiler, ProfileStore
 
 # instantiate the blockchain server
 info = Info(title="Money Lender Blockchain", version='1.0.0', description="""This is a blockchain implementation for a money lender. </br>
@@ -28,33 +42,152 @@ info = Info(title="Money Lender Blockchain", version='1.0.0', description="""Thi
 
 money_lender_app = OpenAPI("Money Lender Blockchain", info=info)
 
-money_lender_blockchain = MoneyLenderBlockChain()
+# built by create_app, importing this module has no side effects so the mining and validation process pools
+# can re-import it under the spawn start method (Windows, macOS) without opening the chain log again
+money_lender_blockchain = None
+mining_scheduler = None
+peer_node = None
+
+def create_app():
+    global money_lender_blockchain, mining_scheduler, peer_node
+    if money_lender_blockchain is not None:
+        return money_lender_app
+    
+    # the ledger is persisted to an append only log and replayed on start up,
+    # its checkpoints are verified with the public key file MONEY_LENDER_CHECKPOINT_KEY or the node key next to the log
+    money_lender_blockchain = MoneyLenderBlockChain(logPath=os.environ.get("MONEY_LENDER_CHAIN_LOG", "money_lender_chain.log"),
+                                                    checkpointKeyPath=os.environ.get("MONEY_LENDER_CHECKPOINT_KEY"))
+    atexit.register(money_lender_blockchain.close)
+    
+    # checkpoint and prune every so many accounts, 0 keeps every account, the pruned accounts are archived next to the log
+    money_lender_blockchain.checkpointEvery = int(os.environ.get("MONEY_LENDER_CHECKPOINT_EVERY", "0"))
+    money_lender_blockchain.archivePruned = os.environ.get("MONEY_LENDER_ARCHIVE_PRUNED", "1") == "1"
+    if money_lender_blockchain.checkpointEvery:
+        # the first checkpoint is taken while an account is appended, its node key is made ahead of it
+        threading.Thread(target=money_lender_blockchain.node_key, name="node-key", daemon=True).start()
+    
+    # the most pending requests mined into one account
+    money_lender_blockchain.maxBatchSize = int(os.environ.get("MONEY_LENDER_MAX_BATCH_SIZE", "1000"))
+    
+    # mine in the background, on request or when the pending pool is large or has waited long enough
+    mining_scheduler = MiningScheduler(money_lender_blockchain,
+                                       pendingThreshold=int(os.environ.get("MONEY_LENDER_MINE_THRESHOLD", "100")),
+                                       interval=float(os.environ.get("MONEY_LENDER_MINE_INTERVAL", "60"))).start()
+    
+    # keep keys ready for the groups that become fully funded
+    money_lender_blockchain.keyPool.start()
+    
+    # other nodes of the network, started with the server
+    peer_node = PeerNode(money_lender_blockchain, selfUrl=os.environ.get("MONEY_LENDER_NODE_URL"),
+                         syncInterval=float(os.environ.get("MONEY_LENDER_SYNC_INTERVAL", "30")))
+    
+    # the chain size is read when the metrics are scraped
+    REGISTRY.gauge("money_lender_chain_height", "Accounts in the blockchain",
+                   function=lambda: len(money_lender_blockchain.AccountChain))
+    REGISTRY.gauge("money_lender_pending_requests", "Lending requests waiting to be mined",
+                   function=lambda: len(money_lender_blockchain.pendingRequests))
+    return money_lender_app
+
+# requests sent with the X-Profile: 1 header are sampled when profiling is turned on,
+# the response carries the X-Profile-Id to read the profile back from /profile
+profiling_enabled = os.environ.get("MONEY_LENDER_PROFILING", "0") == "1"
+profiles = ProfileStore()
+
+@money_lender_app.before_request
+def start_request_timer():
+    g.requestStarted = time.perf_counter()
+    if profiling_enabled and http_request.headers.get("X-Profile") == "1":
+        g.profiler = SamplingProfiler(threading.get_ident()).start()
+
+@money_lender_app.after_request
+def record_request_metrics(response):
+    # streamed bodies are generated after this point, their latency is the time to the first byte
+    endpoint = http_request.url_rule.rule if http_request.url_rule is not None else "unmatched"
+    REQUEST_SECONDS.observe(time.perf_counter() - g.requestStarted, method=http_request.method, endpoint=endpoint,
+                            status=response.status_code)
+    
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        response.headers["X-Profile-Id"] = profiles.add(profiler.stop())
+    return response
 
 # sample lending requests
 #money_lender_blockchain.create_new_lending_request("Femi", "John", 100)
 
-# show the accounts as json
-@money_lender_app.get('/accounts', summary="List all account blocks in the blockchain")
-def show_accounts():
-    accounts = []
-    for acc in money_lender_blockchain.AccountChain:
-        request = acc.lendingRequest
-        accounts.append({
-                "lendingRequest": [
-                        {
-                            "lender": request.lender,
-                            "borrower": request.borrower,
-                            "amount": request.amount,
-                            "requestDate": request.requestDate,
-                            "requestHash": request.requestHash
-                        }
-                    ],
-                "lastAccount": acc.lastAccount,
-                "creationDate": acc.creationDate,
-                "hashState": acc.hashState 
+def account_to_json(acc):
+    # the mining reward comes first, then the batched requests
+    requests = []
+    for request in money_lender_blockchain.account_requests(acc):
+        requests.append({
+                "lender": request.lender,
+                "borrower": request.borrower,
+                "amount": request.amount,
+                "requestDate": request.requestDate,
+                "requestHash": request.requestHash
             })
+        
+    return [{
+            "lendingRequest": requests,
+            "lastAccount": acc.lastAccount,
+            "creationDate": acc.creationDate,
+            "merkleRoot": acc.merkleRoot,
+            "hashState": acc.hashState 
+        }]
     
-    return jsonify(accounts)
+def lender_requests_to_json(acc):
+    lenders = []
+    for request in money_lender_blockchain.account_requests(acc):
+        lenders.append({
+                "lender": request.lender,
+                "borrower": request.borrower,
+                "amount": request.amount,
+                "requestDate": request.requestDate
+            })
+    return lenders
+
+def stream_account_page(query, to_items):
+    chain = money_lender_blockchain.AccountChain
+    height = len(chain)
+    
+    # the blocks below the tip never change, so the tip hash state identifies every page of the chain
+    etag = "%s-%s-%s-%s-%s" % (chain.tip_hash(), height, query.cursor, query.limit, query.format)
+    if http_request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    
+    start = min(max(query.cursor, chain.base), height)
+    end = height if query.limit is None else min(start + max(query.limit, 0), height)
+    
+    # the blocks are serialised one at a time while the response is sent
+    def generate_ndjson():
+        for i in range(start, end):
+            for item in to_items(chain[i]):
+                yield json.dumps(item) + "\n"
+            
+    def generate_json():
+        separator = ""
+        yield "["
+        for i in range(start, end):
+            for item in to_items(chain[i]):
+                yield separator + json.dumps(item)
+                separator = ","
+        yield "]\n"
+    
+    if query.format == "ndjson":
+        response = Response(stream_with_context(generate_ndjson()), mimetype="application/x-ndjson")
+    else:
+        response = Response(stream_with_context(generate_json()), mimetype="application/json")
+        
+    response.set_etag(etag)
+    if end < height:
+        response.headers["X-Next-Cursor"] = str(end)
+    return response
+
+# show the accounts as json, paginated by block height with cursor and limit
+@money_lender_app.get('/accounts', summary="List all account blocks in the blockchain")
+def show_accounts(query: chain_page):
+    return stream_account_page(query, account_to_json)
 
 # get list of pending requests
 @money_lender_app.get('/pending_requests', summary="List all pending requests")
@@ -72,10 +205,26 @@ def show_pending_requests():
 
 # process all prending requests
 @money_lender_app.post('/process_requests', summary="Process all pending requests")
-def process_requests():
-    money_lender_blockchain.process_pending_requests()
+def process_requests(query: process_query):
+    # queue a mining job, wait=true holds the request until the job has finished
+    job = mining_scheduler.submit()
+    if not query.wait:
+        return jsonify({"message": "Mining job queued", "jobId": job.jobId, "status": job.status}), 202
+    
+    job.wait()
+    if job.status == "failed":
+        return jsonify({"message": "Mining job failed", "jobId": job.jobId, "error": job.error}), 500
+    
+    return jsonify({"message": "All pending requests have been processed", "jobId": job.jobId, "status": job.status})
+
+# status of a mining job
+@money_lender_app.get('/mining_job', summary="Get the status of a mining job")
+def get_mining_job(query: mining_job_query):
+    job = mining_scheduler.get_job(query.jobId)
+    if job is None:
+        return jsonify({"message": "Mining job not found"}), 404
     
-    return jsonify({"message": "All pending requests have been processed"})
+    return jsonify(job.to_json())
 
 
 
@@ -89,11 +238,91 @@ def create_new_lending_request(query: create_request):
     res = money_lender_blockchain.create_new_lending_request(lender, borrower, amount)
     
     return res
+
+# create many lending requests in one call, the body is a json array of requests or one json request per line (ndjson),
+# a row repeating a pending request or an earlier row is rejected as a duplicate, so a retried load is not applied twice
+@money_lender_app.post('/create_lending_requests/bulk', summary="Create many lending requests from a json array or ndjson")
+def create_lending_requests_bulk():
+    try:
+        body = http_request.get_data(as_text=True)
+        if http_request.mimetype == "application/x-ndjson":
+            items = [json.loads(line) for line in body.splitlines() if line.strip() != ""]
+        else:
+            items = json.loads(body)
+    except ValueError:
+        return jsonify({"message": "The body must be a json array or ndjson lending requests"}), 400
+    
+    if not isinstance(items, list):
+        return jsonify({"message": "The body must be a json array or ndjson lending requests"}), 400
+    if len(items) > money_lender_blockchain.maxBulkSize:
+        return jsonify({"message": "At most %d lending requests per call" % money_lender_blockchain.maxBulkSize}), 413
+    
+    # rows that are not well formed are rejected here, the others are validated by the chain in one pass
+    report = [None] * len(items)
+    rows = []
+    positions = []
+    for position, item in enumerate(items):
+        try:
+            row = create_request.parse_obj(item)
+        except ValidationError as error:
+            message = "; ".join("%s: %s" % (".".join(str(loc) for loc in e["loc"]), e["msg"]) for e in error.errors())
+            report[position] = {"row": position, "accepted": False, "message": message}
+            continue
+        rows.append((row.lender, row.borrower, row.amount))
+        positions.append(position)
+        
+    for position, entry in zip(positions, money_lender_blockchain.create_lending_requests_bulk(rows)):
+        entry["row"] = position
+        report[position] = entry
+    
+    accepted = sum(1 for entry in report if entry["accepted"])
+    return jsonify({"accepted": accepted, "rejected": len(report) - accepted, "requests": report})
     
 # get the balance of a lender
 @money_lender_app.get('/lender/balance', summary="Get the balance of a lender")
 def get_lender_balance(query: balance):
-    return jsonify({"balance": money_lender_blockchain.calculate_lender_balance(query.lender)})
+    return jsonify({"balance": money_lender_blockchain.calculate_lender_balance(query.lender),
+                    "available": money_lender_blockchain.calculate_available_balance(query.lender)})
+
+# the accounts a lender sent or received money in, between two dates
+@money_lender_app.get('/lender/history', summary="Get the transaction history of a lender between two dates")
+def get_lender_history(query: party_history):
+    party = money_lender_blockchain.normalize_party(query.lender)
+    history, next_cursor = money_lender_blockchain.party_history(query.lender, query.start, query.end,
+                                                                 query.cursor, query.limit)
+    
+    items = []
+    for height, change, balance_after in history:
+        account = money_lender_blockchain.AccountChain[height]
+        requests = []
+        for request in money_lender_blockchain.account_requests(account):
+            if party in (money_lender_blockchain.normalize_party(request.lender),
+                         money_lender_blockchain.normalize_party(request.borrower)):
+                requests.append({
+                        "lender": request.lender,
+                        "borrower": request.borrower,
+                        "amount": request.amount,
+                        "requestDate": request.requestDate,
+                        "requestHash": request.requestHash
+                    })
+        items.append({
+                "height": height,
+                "creationDate": account.creationDate,
+                "hashState": account.hashState,
+                "change": change,
+                "balance": balance_after,
+                "lendingRequests": requests
+            })
+    
+    return jsonify({"lender": query.lender, "history": items, "nextCursor": next_cursor})
+
+# the balance of a lender at a point in time
+@money_lender_app.get('/lender/balance_at', summary="Get the balance of a lender at a date")
+def get_lender_balance_at(query: balance_at_query):
+    balance_then, height = money_lender_blockchain.balance_at(query.lender, query.at)
+    if balance_then is None:
+        return jsonify({"message": "The accounts before the checkpoint have been pruned"}), 404
+    return jsonify({"lender": query.lender, "at": query.at, "balance": balance_then, "height": height})
 
 # create lending group
 @money_lender_app.post('/create_lending_group/', summary="Create a new lending group")
@@ -129,7 +358,8 @@ def show_lending_groups():
             lenders.append({
                 "name": lender.name,
                 "amount": lender.amount,
-                "proof_of_participation_key": lender.proof_of_participation_key
+                "proof_of_participation_key": lender.proof_of_participation_key,
+                "proof_of_participation_signature": lender.proof_of_participation_signature
             })
             
                       
@@ -139,25 +369,136 @@ def show_lending_groups():
                 "splitRate_inPercent": group.splitRate_inPercent,
                 "groupCreationDate": group.groupCreationDate,
                 "groupHash": group.groupHash,                
+                "publicKey": group.publicKey,
                 "lenders": lenders,                
             })
     
     return jsonify(groups)
 
-# list all lenders in the account blocks in the blockchain
+# verify the proofs of participation of many groups at once
+@money_lender_app.post('/lending_groups/verify', summary="Verify the proof of participation of the lending groups")
+def verify_lending_groups(query: verify_groups):
+    names = None
+    if query.names:
+        names = [name.strip() for name in query.names.split(",") if name.strip() != ""]
+    
+    groups = money_lender_blockchain.verify_lender_groups(names)
+    return jsonify({
+            "valid": all(group["valid"] for group in groups if group["signed"]),
+            "groups": groups
+        })
+
+# list all lenders in the account blocks in the blockchain, paginated by block height with cursor and limit
 @money_lender_app.get('/lender_requests', summary="List all lender requests (transactions) in the blockchain")
-def show_lenders():
-    lenders = []
-    for acc in money_lender_blockchain.AccountChain:
-        request = acc.lendingRequest
-        lenders.append({
-                "lender": request.lender,
-                "borrower": request.borrower,
-                "amount": request.amount,
-                "requestDate": request.requestDate
-            })
+def show_lenders(query: chain_page):
+    return stream_account_page(query, lender_requests_to_json)
+
+# merkle inclusion proof of a request in its batched account block
+@money_lender_app.get('/merkle_proof', summary="Get the merkle inclusion proof of a lending request")
+def get_merkle_proof(query: merkle_proof_query):
+    proof = money_lender_blockchain.get_merkle_proof(query.requestHash)
+    if proof is None:
+        return jsonify({"message": "The lending request is not in a batched account block"}), 404
     
-    return jsonify(lenders)
+    return jsonify(proof)
+
+# health check, only the accounts appended since the last check are verified
+@money_lender_app.get('/health', summary="Check the blockchain health")
+def get_health():
+    return jsonify({
+            "valid": money_lender_blockchain.is_the_blockchain_valid(),
+            "height": len(money_lender_blockchain.AccountChain),
+            "verifiedHeight": money_lender_blockchain.verifiedHeight,
+            "pendingRequests": len(money_lender_blockchain.pendingRequests)
+        })
+
+# the latest signed checkpoint
+@money_lender_app.get('/checkpoint', summary="Get the latest chain checkpoint")
+def get_checkpoint():
+    if money_lender_blockchain.checkpoint is None:
+        return jsonify({"message": "No checkpoint has been taken"}), 404
+    
+    return jsonify(money_lender_blockchain.checkpoint.to_json(money_lender_blockchain.trusted_checkpoint_key()))
+
+# take a checkpoint at the current height
+@money_lender_app.post('/checkpoint', summary="Take a signed checkpoint of the balances and prune the accounts below it")
+def create_checkpoint(query: checkpoint_query):
+    checkpoint = money_lender_blockchain.create_checkpoint(query.prune)
+    if checkpoint is None:
+        return jsonify({"message": "The blockchain is not valid, no checkpoint was taken"}), 409
+    
+    return jsonify(dict(checkpoint.to_json(money_lender_blockchain.trusted_checkpoint_key()), prunedBelow=money_lender_blockchain.AccountChain.base))
+
+# metrics in the prometheus text format
+@money_lender_app.get('/metrics', summary="Get the service metrics in the Prometheus text format")
+def get_metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+# sampled stacks of a profiled request
+@money_lender_app.get('/profile', summary="Get the profile of a request sent with the X-Profile header")
+def get_profile(query: profile_query):
+    profiler = profiles.get(query.profileId)
+    if profiler is None:
+        return jsonify({"message": "Profile not found"}), 404
+    
+    if query.format == "collapsed":
+        return Response(profiler.collapsed(), mimetype="text/plain")
+    return jsonify(profiler.to_json())
+
+# verify the whole blockchain from scratch
+@money_lender_app.post('/audit', summary="Verify every account block in the blockchain")
+def audit_blockchain():
+    first_bad_height = money_lender_blockchain.audit_blockchain()
+    
+    return jsonify({
+            "valid": first_bad_height is None,
+            "height": len(money_lender_blockchain.AccountChain),
+            "firstBadHeight": first_bad_height
+        })
+
+# register a peer node, the response lists the peers known here one per line
+@money_lender_app.post('/peers/register', summary="Register a peer node")
+def register_peer(query: peer_register):
+    peer_node.add_peer(query.url)
+    return Response("\n".join([peer_node.selfUrl or ""] + peer_node.known_peers()), mimetype="text/plain")
+
+@money_lender_app.get('/peers', summary="List the peer nodes")
+def show_peers():
+    return jsonify({"self": peer_node.selfUrl, "peers": peer_node.known_peers(), "failures": peer_node.failures})
+
+# the accounts after the fork point with the caller, as compact binary records
+@money_lender_app.get('/peers/blocks', summary="Get the accounts after the last hash state shared with a peer")
+def get_peer_blocks(query: peer_blocks):
+    locator = [hashState for hashState in query.locator.split(",") if hashState != ""]
+    start, records = money_lender_blockchain.blocks_after(locator, min(max(query.limit, 0), 5000))
+    response = Response(encode_blocks(records), mimetype=BINARY_MIMETYPE)
+    response.headers["X-Start-Height"] = str(start)
+    response.headers["X-Chain-Height"] = str(len(money_lender_blockchain.AccountChain))
+    return response
+
+# accounts gossiped by a peer
+@money_lender_app.post('/peers/blocks', summary="Receive accounts from a peer")
+def receive_peer_blocks():
+    try:
+        adopted = peer_node.receive_blocks(http_request.get_data(), http_request.headers.get("X-Peer"))
+    except (ValueError, struct.error):
+        return jsonify({"message": "The accounts could not be decoded"}), 400
+    return jsonify({"adopted": adopted, "height": len(money_lender_blockchain.AccountChain)})
+
+# pending requests gossiped by a peer
+@money_lender_app.post('/peers/pending', summary="Receive pending lending requests from a peer")
+def receive_peer_pending():
+    try:
+        accepted = peer_node.receive_pending(http_request.get_data(), http_request.headers.get("X-Peer"))
+    except (ValueError, struct.error):
+        return jsonify({"message": "The lending requests could not be decoded"}), 400
+    return jsonify({"accepted": len(accepted)})
+
+# catch up with every peer now
+@money_lender_app.post('/peers/sync', summary="Catch up with the peer nodes")
+def sync_peers():
+    changed = peer_node.sync_all()
+    return jsonify({"changedBy": changed, "height": len(money_lender_blockchain.AccountChain)})
 
 @money_lender_app.route('/', methods=['GET'])
 def get_root():
@@ -182,5 +523,25 @@ def get_root():
 
 # Instantiate the Blockchain Network and create the first block
 if __name__ == '__main__':
+    # several nodes can run side by side, each with its own port, chain log (MONEY_LENDER_CHAIN_LOG) and peers
+    parser = argparse.ArgumentParser(description="Money Lender Blockchain node")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--url", help="address the peers reach this node on, defaults to http://127.0.0.1:<port>")
+    parser.add_argument("--peers", default="", help="comma separated addresses of the peer nodes")
+    args = parser.parse_args()
+    
+    create_app()
+    peer_node.selfUrl = peer_node.selfUrl or args.url or "http://127.0.0.1:%d" % args.port
+    peer_node.start()
+    
+    # register and catch up once the server is listening
+    def join_network():
+        for peer in args.peers.split(","):
+            if peer.strip() != "":
+                peer_node.register_with(peer.strip())
+        peer_node.sync_all()
+    threading.Timer(1.0, join_network).start()
+    
     # Start the Blockchain Server
-    money_lender_app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    money_lender_app.run(host=args.host, port=args.port, threaded=True)
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""_summary_
+    ASGI entry point of the Money Lender Blockchain api.
+    The Flask handlers run on thread pools beside the event loop, reads and writes on separate pools so the balance
+    and pending request reads never queue behind a slow write, and the responses are streamed back to the client
+    a chunk at a time. The mining and the chain audits already run on their own threads and process pools.
+
+    One process, the chain log is locked so a second process without a chain owner fails to start:
+        uvicorn money_lender_asgi:application --port 5000
+
+    Several worker processes sharing one chain, the workers forward the requests to the chain owner over local IPC:
+        python chain_ipc.py --address 127.0.0.1:5050
+        set MONEY_LENDER_CHAIN_OWNER=127.0.0.1:5050
+        uvicorn money_lender_asgi:application --port 5000 --workers 4
+"""
+
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from chain_ipc import ChainClient, wsgi_events
+
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# chunks of a response held between the handler thread and the event loop before the handler waits for the client
+STREAM_BUFFER = 16
+
+
+def build_environ(scope, body):
+    # the WSGI environ of an ASGI http scope, plain strings only so it can be sent to the chain owner
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+            "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+            "SERVER_NAME": str(server[0]),
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+            "REMOTE_ADDR": str(client[0]),
+            "REMOTE_PORT": str(client[1]),
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": CHAIN_OWNER is not None,
+            "wsgi.run_once": False
+        }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = "HTTP_" + name
+            environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+class WsgiBridge:
+    # serves ASGI http requests with a function returning the wsgi_events of a request
+    def __init__(self, events, readThreads=16, writeThreads=4):
+        self.events = events
+        self.readPool = ThreadPoolExecutor(readThreads, thread_name_prefix="api-read")
+        self.writePool = ThreadPoolExecutor(writeThreads, thread_name_prefix="api-write")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError("unsupported scope type %s" % scope["type"])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.readPool.shutdown(wait=False)
+                self.writePool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope, receive, send):
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        body = b''.join(chunks)
+        environ = build_environ(scope, body)
+
+        loop = asyncio.get_running_loop()
+        stream = asyncio.Queue(STREAM_BUFFER)
+        cancelled = []
+
+        def produce():
+            # runs on the pool, each event waits for room in the stream so a slow client holds back the handler
+            try:
+                for event in self.events(environ, body):
+                    if cancelled:
+                        return
+                    asyncio.run_coroutine_threadsafe(stream.put(event), loop).result()
+            except BaseException as error:
+                asyncio.run_coroutine_threadsafe(stream.put(("error", error)), loop).result()
+            else:
+                asyncio.run_coroutine_threadsafe(stream.put(("end",)), loop).result()
+
+        pool = self.readPool if scope["method"] in READ_METHODS else self.writePool
+        producer = loop.run_in_executor(pool, produce)
+        started = False
+        try:
+            while True:
+                event = await stream.get()
+                if event[0] == "start":
+                    await send({"type": "http.response.start", "status": event[1],
+                                "headers": [(name.lower().encode("latin1"), value.encode("latin1"))
+                                            for name, value in event[2]]})
+                    started = True
+                elif event[0] == "body":
+                    await send({"type": "http.response.body", "body": event[1], "more_body": True})
+                elif event[0] == "error":
+                    if started:
+                        raise event[1]
+                    print(event[1], file=sys.stderr)
+                    await send({"type": "http.response.start", "status": 500,
+                                "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+                    await send({"type": "http.response.body", "body": b"Internal Server Error"})
+                    return
+                else:
+                    await send({"type": "http.response.body", "body": b""})
+                    return
+        finally:
+            # stop the handler when the client has gone, and make room for the event it is waiting to put
+            cancelled.append(True)
+            while not producer.done():
+                try:
+                    stream.get_nowait()
+                except asyncio.QueueEmpty:
+                    await asyncio.wait([producer], timeout=0.05)
+
+
+CHAIN_OWNER = os.environ.get("MONEY_LENDER_CHAIN_OWNER")
+READ_THREADS = int(os.environ.get("MONEY_LENDER_READ_THREADS", "16"))
+WRITE_THREADS = int(os.environ.get("MONEY_LENDER_WRITE_THREADS", "4"))
+
+if CHAIN_OWNER is not None:
+    # a worker process, the chain lives in the chain owner
+    chain_client = ChainClient(CHAIN_OWNER)
+    application = WsgiBridge(chain_client.http, READ_THREADS, WRITE_THREADS)
+else:
+    import money_lender_app
+    wsgi_app = money_lender_app.create_app()
+    money_lender_app.peer_node.start()
+    application = WsgiBridge(lambda environ, body: wsgi_events(wsgi_app, environ, body), READ_THREADS, WRITE_THREADS)
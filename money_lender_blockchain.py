@@ -1,15 +1,228 @@
-from lending_requests import LendingRequest, Account, GroupLender, AccountM, LendingRequestM, GroupLenderM, Lender
+from lending_requests import LendingRequest, Account, GroupLender, AccountM, LendingRequestM, GroupLenderM, Lender, HASH_VERSION_BATCH
+from lending_requests import difficulty_target, to_epoch_micros, from_epoch_micros
 from flask import jsonify
+from mining import MiningEngine
+from chain_log import ChainLog
+from chain_store import CompactChain, BlockRecord
+from chain_validation import audit_accounts, first_bad_hash, first_bad_link
+from merkle import merkle_proof, verify_merkle_proof
+from key_pool import KeyPool
+from checkpoints import Checkpoint, save_checkpoint, load_checkpoint, load_or_create_key, load_trusted_key
+from metrics import VALIDATION_SECONDS, BALANCE_LOOKUPS
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from functools import wraps
+import os
+import threading
+import time
+
+def with_chain_lock(method):
+    # mutations of the chain and the pending pool are atomic, reads do not take the lock
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
 
 class MoneyLenderBlockChain:
-    def __init__(self):
+    def __init__(self, logPath = None, checkpointKeyPath = None):
         self.pendingRequests = []
         self.groupLenders = []
         self.maxAmountMinable = 100
         self.miningOutputOwner = "Femi"
         self.miningDifficulty = 3
-        self.AccountChain = []
-        self.create_initial_account()
+        self.hashVersion = HASH_VERSION_BATCH
+        self.maxBatchSize = 1000
+        self.maxBulkSize = 50000
+        
+        # seconds a peer account may be dated ahead of the local clock
+        self.maxClockDrift = 15
+        self.miningWorkers = os.cpu_count() or 1
+        self.miningEngine = MiningEngine(self.miningWorkers)
+        
+        # pre-generated keys for signing the proof of participation of fully funded groups
+        self.keyPool = KeyPool()
+        
+        # the accounts are stored as compact records, indexing the chain returns the pydantic models
+        self.AccountChain = CompactChain()
+        
+        # the chain lock guards appends and the pending pool, the mining lock allows one mining round at a time
+        self.lock = threading.RLock()
+        self.miningLock = threading.Lock()
+        
+        # balance index keyed on the normalized party name, and amounts
+        # already committed by each lender in the pending pool
+        self.balanceIndex = {}
+        self.pendingCommitted = {}
+        
+        # lending groups keyed on the normalized group name, the normalized names of each group's lenders,
+        # and the hashes of the pending requests
+        self.groupIndex = {}
+        self.groupMembers = {}
+        self.pendingHashes = set()
+        
+        # number of pending requests with each (lender, borrower, amount), a request repeating one is a duplicate
+        self.pendingContents = {}
+        
+        # height of the account holding each request hash, built on the first merkle proof lookup,
+        # and height of each account hash state, built on the first peer lookup
+        self.requestIndex = None
+        self.blockIndex = None
+        
+        # heights of the accounts of each party with the party's balance after each of them,
+        # and the creation date of every account, built on the first history lookup
+        self.historyIndex = None
+        self.creationDates = None
+        self.historyBase = 0
+        
+        # called with the accounts mined and the pending requests created on this node, the peer node gossips them
+        self.blockListeners = []
+        self.pendingListeners = []
+        
+        # accounts below this height have already been verified
+        self.verifiedHeight = 0
+        
+        # the latest signed checkpoint, the accounts below its tip are pruned,
+        # a checkpoint is taken every `checkpointEvery` accounts when it is set, and the pruned accounts are archived
+        self.checkpoint = None
+        self.checkpointEvery = 0
+        self.archivePruned = True
+        self.nodeKey = None
+        self.nodeKeyLock = threading.Lock()
+        
+        # the checkpoints are verified with the public key in this file, or with the node key next to the chain log
+        self.checkpointKeyPath = checkpointKeyPath
+        
+        # replay the on-disk log when there is one, only a new ledger mines a genesis account
+        self.chainLog = None
+        self.balanceSnapshotEvery = 10000
+        if logPath is not None:
+            self.chainLog = ChainLog(logPath)
+            self.load_from_log()
+            
+        if len(self.AccountChain) == 0:
+            self.create_initial_account()
+            
+    def load_from_log(self):
+        self.checkpoint = load_checkpoint(self.chainLog.checkpointPath)
+        if self.checkpoint is None:
+            self.AccountChain = CompactChain(self.chainLog.load_blocks())
+        else:
+            self.load_pruned_blocks()
+        self.pendingRequests, self.groupLenders = self.chainLog.replay_journal()
+        self.drop_mined_pending_requests()
+        self.rebuild_group_index()
+        
+        # start from the balance snapshot when it still matches the chain, only the blocks after it are read
+        snapshot = self.chainLog.load_balances()
+        if snapshot is not None:
+            height, hashState, balances = snapshot
+            if (self.AccountChain.base < height <= len(self.AccountChain)
+                    and self.AccountChain.record(height - 1).hashState.hex() == hashState):
+                self.rebuild_balance_index(height, balances)
+                return
+            
+        self.rebuild_balance_index()
+        
+    def drop_mined_pending_requests(self):
+        # an account is appended to the log before the removal of its requests is journaled,
+        # a crash in between leaves them pending although they are already on the chain,
+        # only the accounts above the height of the last journaled removal can hold them
+        if len(self.pendingRequests) == 0:
+            return
+        pending = set(bytes.fromhex(request.requestHash) for request in self.pendingRequests)
+        mined = set(request.requestHash.hex() for record in self.AccountChain.records(self.chainLog.minedHeight)
+                    for request in self.account_requests(record) if request.requestHash in pending)
+        if len(mined) > 0:
+            self.chainLog.remove_pending(mined, len(self.AccountChain))
+            self.pendingRequests = [request for request in self.pendingRequests if request.requestHash not in mined]
+        
+    def load_pruned_blocks(self):
+        # the log starts at the checkpoint tip, unless the node stopped between the checkpoint and the pruning
+        # or the checkpoint was taken without pruning, then it starts at the genesis account or an older checkpoint tip
+        if not self.verify_checkpoint(self.checkpoint):
+            raise ValueError("The signature of the chain checkpoint %s is not valid" % self.chainLog.checkpointPath)
+        
+        blocks = self.chainLog.load_blocks()
+        if len(blocks) > 0 and blocks.hash_state(0) != self.checkpoint.tipHash:
+            tip = next((index for index in range(len(blocks)) if blocks.hash_state(index) == self.checkpoint.tipHash), None)
+            if tip is not None:
+                self.chainLog.prune_blocks(tip, self.archivePruned)
+                blocks = self.chainLog.load_blocks()
+        if len(blocks) == 0 or blocks.hash_state(0) != self.checkpoint.tipHash:
+            raise ValueError("The chain log does not start at the checkpoint tip")
+        
+        self.AccountChain = CompactChain(blocks, self.checkpoint.base)
+        self.verifiedHeight = self.checkpoint.height
+        
+    def trusted_checkpoint_key(self):
+        if self.checkpointKeyPath is not None:
+            return load_trusted_key(self.checkpointKeyPath)
+        if self.nodeKey is not None:
+            return self.nodeKey[0]
+        if self.chainLog is not None:
+            return load_trusted_key(self.chainLog.keyPath)
+        return None
+    
+    def verify_checkpoint(self, checkpoint):
+        return checkpoint.verify(self.trusted_checkpoint_key())
+        
+    def checkpoint_height(self):
+        return self.checkpoint.height if self.checkpoint is not None else 0
+    
+    def node_key(self):
+        # the node signing key, loaded or generated once, a new key takes seconds to generate
+        with self.nodeKeyLock:
+            if self.nodeKey is None:
+                self.nodeKey = load_or_create_key(self.chainLog.keyPath if self.chainLog is not None else None)
+            return self.nodeKey
+    
+    def create_checkpoint(self, prune = True):
+        # sign the balances at the current height, then drop the accounts below the tip,
+        # the node key is ready before the chain lock is taken
+        public_key, private_key = self.node_key()
+        with self.lock:
+            if not self.is_the_blockchain_valid():
+                return None
+            
+            tip = self.AccountChain.record(-1)
+            checkpoint = Checkpoint(len(self.AccountChain), tip.hashState, tip.creationDate, dict(self.balanceIndex))
+            checkpoint.sign(private_key, public_key)
+            
+            if self.chainLog is not None:
+                save_checkpoint(self.chainLog.checkpointPath, checkpoint)
+            self.checkpoint = checkpoint
+            if prune:
+                self.prune_chain()
+            return checkpoint
+    
+    def prune_chain(self):
+        base = self.checkpoint.base
+        if base <= self.AccountChain.base:
+            return
+        
+        if self.chainLog is not None:
+            self.chainLog.prune_blocks(base - self.AccountChain.base, self.archivePruned)
+            self.AccountChain = CompactChain(self.chainLog.load_blocks(), base)
+        else:
+            self.AccountChain.prune(base)
+            
+        # the lookup indexes are rebuilt from the kept accounts on their next use
+        self.requestIndex = None
+        self.blockIndex = None
+        self.historyIndex = None
+        
+    def save_balance_snapshot(self):
+        self.chainLog.save_balances(len(self.AccountChain), self.AccountChain.tip_hash(), self.balanceIndex)
+        
+    def close(self):
+        if self.chainLog is not None:
+            if len(self.AccountChain) > 0:
+                self.save_balance_snapshot()
+            self.chainLog.close()
+        self.miningEngine.close()
+        self.keyPool.stop()
         
     def create_initial_account(self):
         lastAccount = None
@@ -20,34 +233,448 @@ class MoneyLenderBlockChain:
         
         # add the mined lending request an account
         account = AccountM(lendingRequest = request, lastAccount = lastAccount)
-        account.hashState = Account(account).calculate_hash_state()
+        self.mine_account(account)
         
         # append to the chain
-        self.AccountChain.append(account)
+        self.create_new_account(account)
+        
+    def mine_account(self, account):
+        # search the nonce with the chain difficulty and keep it on the account so it can be verified
+        # new accounts always use the current hash version, older accounts keep verifying with their own
+        account.hashVersion = self.hashVersion
+        if account.hashVersion >= HASH_VERSION_BATCH:
+            account.merkleRoot = Account(account).calculate_merkle_root()
+        nonce, hashState, tried = self.miningEngine.mine(Account(account).hash_prefix(), self.miningDifficulty)
+        account.nonce = nonce
+        account.hashState = hashState
+        return account
         
     def return_last_account(self):
         return self.AccountChain[-1]
     
+    @with_chain_lock
     def create_new_account(self, account):
-        self.AccountChain.append(account)
+        record = account if isinstance(account, BlockRecord) else BlockRecord.from_model(account)
+        if self.chainLog is not None:
+            self.chainLog.append_block(record)
+        self.AccountChain.append(record)
+        for request in self.account_requests(record):
+            self.apply_to_balance_index(request)
+        if self.requestIndex is not None:
+            self.index_account_requests(len(self.AccountChain) - 1, record)
+        if self.blockIndex is not None:
+            self.blockIndex[record.hashState] = len(self.AccountChain) - 1
+        if self.historyIndex is not None:
+            self.index_account_history(len(self.AccountChain) - 1, record)
+        
+        # a recent snapshot keeps the replay short after a crash
+        if self.chainLog is not None and len(self.AccountChain) % self.balanceSnapshotEvery == 0:
+            self.save_balance_snapshot()
+        if self.checkpointEvery and len(self.AccountChain) % self.checkpointEvery == 0:
+            self.create_checkpoint()
+        
+    @staticmethod
+    def account_requests(account):
+        # the mining reward comes first, then the batched requests
+        return [account.lendingRequest] + list(account.lendingRequests)
     
-    def is_the_blockchain_valid(self):
-        for i in range(len(self.AccountChain) - 1):
+    def index_account_requests(self, height, record):
+        # a hash mined twice by an older node that dated its requests at start up keeps its first height
+        for request in self.account_requests(record):
+            self.requestIndex.setdefault(request.requestHash, height)
             
-            # compare hashes between the last account and the current account
-            if self.AccountChain[i].hashState != self.AccountChain[i+1].lastAccount:
+    @with_chain_lock
+    def find_request_height(self, requestHash):
+        if self.requestIndex is None:
+            self.requestIndex = {}
+            for height, record in enumerate(self.AccountChain.records(), self.AccountChain.base):
+                self.index_account_requests(height, record)
+        try:
+            return self.requestIndex.get(bytes.fromhex(requestHash))
+        except ValueError:
+            return None
+    
+    @with_chain_lock
+    def get_merkle_proof(self, requestHash):
+        # the inclusion proof of a request in its batched account, or None when it is not in one
+        height = self.find_request_height(requestHash)
+        if height is None or height < self.AccountChain.base:
+            return None
+        
+        account = self.AccountChain[height]
+        if account.hashVersion < HASH_VERSION_BATCH:
+            return None
+        
+        leaves = [bytes.fromhex(request.requestHash) for request in self.account_requests(account)]
+        index = leaves.index(bytes.fromhex(requestHash))
+        proof = merkle_proof(leaves, index)
+        return {
+                "requestHash": requestHash,
+                "height": height,
+                "hashState": account.hashState,
+                "merkleRoot": account.merkleRoot,
+                "proof": [{"hash": sibling.hex(), "position": position} for sibling, position in proof],
+                "valid": verify_merkle_proof(leaves[index], proof, bytes.fromhex(account.merkleRoot))
+            }
+        
+    @with_chain_lock
+    def find_block_height(self, hashState):
+        if self.blockIndex is None:
+            self.blockIndex = {}
+            for height, record in enumerate(self.AccountChain.records(), self.AccountChain.base):
+                self.blockIndex[record.hashState] = height
+        try:
+            return self.blockIndex.get(bytes.fromhex(hashState))
+        except ValueError:
+            return None
+        
+    @with_chain_lock
+    def block_locator(self):
+        # hash states from the tip back to the oldest account kept, the genesis account or the checkpoint tip,
+        # the step doubles after the ten most recent accounts
+        base = self.AccountChain.base
+        heights = []
+        height = len(self.AccountChain) - 1
+        step = 1
+        while height > base:
+            heights.append(height)
+            if len(heights) >= 10:
+                step *= 2
+            height -= step
+        heights.append(base)
+        return [self.AccountChain.record(height).hashState.hex() for height in heights]
+    
+    @with_chain_lock
+    def blocks_after(self, locator, limit):
+        # the first locator hash found on this chain is the fork point, returns the height after it and up to
+        # `limit` records from there, a locator with no known hash starts from the genesis account,
+        # or from the checkpoint tip on a pruned chain
+        start = 0
+        for hashState in locator:
+            height = self.find_block_height(hashState)
+            if height is not None:
+                start = height + 1
+                break
+        start = max(start, self.AccountChain.base)
+        return start, list(self.AccountChain.records(start, start + limit))
+    
+    def is_valid_segment(self, start, records):
+        # the records must follow the account below `start`, meet the mining difficulty, have valid hash states,
+        # not be dated more than maxClockDrift ahead of the local clock and only move money the way this node would
+        previous = self.AccountChain.record(start - 1) if start > 0 else None
+        target = difficulty_target(self.miningDifficulty)
+        latest = to_epoch_micros(datetime.now()) + self.maxClockDrift * 1000000
+        for record in records:
+            if record.hashState > target or record.creationDate > latest:
                 return False
-            
-            # compare stored hash and calculated hash state
-            if self.AccountChain[i].hashState != self.AccountChain[i].calculate_hash_state():
+        return (first_bad_link(records, start, previous) is None and first_bad_hash(start, records) is None
+                and self.are_transfers_valid(start, records))
+    
+    def are_transfers_valid(self, start, records):
+        # replay the records on the balances at `start` with the rules of create_new_lending_request:
+        # a single mining reward of maxAmountMinable to the mining output owner first in every batched account,
+        # funded requests within the max amount, and no request that is already on the chain below `start`
+        changes = {}
+        for record in self.AccountChain.records(start):
+            for request in self.account_requests(record):
+                self.apply_to_balance_index(request, -1, changes)
+        
+        seen = set()
+        for record in records:
+            requests = self.account_requests(record)
+            rewards = [request for request in requests if request.lender is None]
+            if record.hashVersion >= HASH_VERSION_BATCH and (len(rewards) != 1 or record.lendingRequest.lender is not None):
                 return False
             
-            # latest accounts should have the most recent creation date
-            if self.AccountChain[i].creationDate > self.return_last_account().creationDate:
-                return False           
+            for request in requests:
+                if request.requestHash is not None:
+                    if request.requestHash in seen:
+                        return False
+                    seen.add(request.requestHash)
+                    height = self.find_request_height(request.requestHash.hex())
+                    if height is not None and height < start:
+                        return False
+                
+                if request.lender is None:
+                    if (self.normalize_party(request.borrower) != self.normalize_party(self.miningOutputOwner)
+                            or request.amount != self.maxAmountMinable):
+                        return False
+                    self.apply_to_balance_index(request, 1, changes)
+                else:
+                    lender = self.normalize_party(request.lender)
+                    if request.lender == "" or request.borrower == "" or lender == self.normalize_party(request.borrower):
+                        return False
+                    if request.amount <= 0 or request.amount > self.maxAmountMinable:
+                        return False
+                    if not self.replay_transfer(request, changes):
+                        return False
+        return True
+    
+    def replay_transfer(self, request, changes):
+        # apply the request to the balance changes when its lender can fund it from the balances and the changes
+        lender = self.normalize_party(request.lender)
+        if request.amount > self.balanceIndex.get(lender, 0) + changes.get(lender, 0):
+            return False
+        self.apply_to_balance_index(request, 1, changes)
+        return True
+    
+    @with_chain_lock
+    def adopt_blocks(self, start, records):
+        # longest valid chain: the records replace the accounts from `start` up if they make the chain longer
+        if len(records) == 0 or start > len(self.AccountChain) or start + len(records) <= len(self.AccountChain):
+            return False
+        
+        # the accounts up to the checkpoint are final
+        if start < self.checkpoint_height():
+            return False
+        if not self.is_valid_segment(start, records):
+            return False
+        
+        verified = self.verifiedHeight >= start
+        orphaned = self.truncate_chain(start)
+        for record in records:
+            self.create_new_account(record)
+        if verified:
+            self.verifiedHeight = len(self.AccountChain)
+        
+        # the adopted requests leave the pending pool, the orphaned ones that are not in the new accounts go back to it
+        adopted = set(request.requestHash for record in records for request in self.account_requests(record))
+        self.remove_pending_requests([request for request in self.pendingRequests
+                                      if bytes.fromhex(request.requestHash) in adopted])
+        self.accept_pending_requests([request.to_model() for record in orphaned for request in record.lendingRequests
+                                      if request.requestHash not in adopted])
+        self.settle_pending_requests()
+        return True
+    
+    def settle_pending_requests(self):
+        # the balances changed under the pending pool, the requests are kept in pool order while the new balances
+        # fund them and the others are dropped, so any batch of the pool can still be mined
+        committed = {}
+        dropped = []
+        for request in self.pendingRequests:
+            lender = self.normalize_party(request.lender)
+            if request.amount > self.balanceIndex.get(lender, 0) - committed.get(lender, 0):
+                dropped.append(request)
+            else:
+                committed[lender] = committed.get(lender, 0) + request.amount
+        self.remove_pending_requests(dropped)
+        self.pendingCommitted = committed
+    
+    def truncate_chain(self, height):
+        # drop the accounts from `height` up and take their requests out of the indexes, returns the dropped records
+        orphaned = list(self.AccountChain.records(height))
+        for record in orphaned:
+            for request in self.account_requests(record):
+                self.apply_to_balance_index(request, -1)
+                if self.requestIndex is not None and self.requestIndex.get(request.requestHash, -1) >= height:
+                    del self.requestIndex[request.requestHash]
+            if self.blockIndex is not None:
+                self.blockIndex.pop(record.hashState, None)
+                
+        # the accounts replacing the dropped ones are only looked at after a crash if they are above the mined height
+        if self.chainLog is not None:
+            if self.chainLog.minedHeight > height:
+                self.chainLog.remove_pending([], height)
+            self.chainLog.truncate_blocks(height - self.AccountChain.base)
+        self.AccountChain.truncate(height)
+        self.verifiedHeight = min(self.verifiedHeight, height)
+        
+        if self.historyIndex is not None:
+            del self.creationDates[height - self.historyBase:]
+            for heights, balances in self.historyIndex.values():
+                while len(heights) > 0 and heights[-1] >= height:
+                    heights.pop()
+                    balances.pop()
+        return orphaned
+    
+    @with_chain_lock
+    def accept_pending_requests(self, requests):
+        # add pending requests created on another node, returns the ones that were new and valid here
+        accepted = []
+        for request in requests:
+            if request.lender is None or request.requestHash in self.pendingHashes:
+                continue
+            if request.requestHash != LendingRequest(request).calculate_request_hash():
+                continue
+            if request.lender.lower() == request.borrower.lower() or request.amount <= 0:
+                continue
+            if request.amount > self.maxAmountMinable or request.amount > self.calculate_available_balance(request.lender):
+                continue
+            if self.find_request_height(request.requestHash) is not None:
+                continue
+            
+            # requests older than the checkpoint tip have been mined in the pruned accounts or are stale
+            if self.checkpoint is not None and to_epoch_micros(request.requestDate) < self.checkpoint.tipCreationDate:
+                continue
+            
+            self.pendingRequests.append(request)
+            self.pendingHashes.add(request.requestHash)
+            self.commit_pending_amount(request)
+            accepted.append(request)
             
+        if self.chainLog is not None:
+            self.chainLog.append_pending_many(accepted)
+        return accepted
+        
+    def index_account_history(self, height, record):
+        self.creationDates.append(record.creationDate)
+        
+        # the net change of each party in the account
+        changes = {}
+        for request in self.account_requests(record):
+            lender = self.normalize_party(request.lender)
+            if lender is not None:
+                changes[lender] = changes.get(lender, 0) - request.amount
+            borrower = self.normalize_party(request.borrower)
+            changes[borrower] = changes.get(borrower, 0) + request.amount
+            
+        for party, change in changes.items():
+            if party not in self.historyIndex:
+                self.historyIndex[party] = (array('Q'), array('q'))
+            heights, balances = self.historyIndex[party]
+            heights.append(height)
+            balances.append((balances[-1] if len(balances) > 0 else self.history_start_balance(party)) + change)
+            
+    def history_start_balance(self, party):
+        # the history of a pruned chain starts from the checkpoint balances
+        if self.checkpoint is not None and self.historyBase > 0:
+            return self.checkpoint.balances.get(party, 0)
+        return 0
+            
+    def ensure_history_index(self):
+        # the history starts after the checkpoint, the creation dates are those of the accounts from historyBase up
+        if self.historyIndex is None:
+            self.historyIndex = {}
+            self.creationDates = array('q')
+            self.historyBase = self.checkpoint_height() if self.AccountChain.base > 0 else 0
+            for height, record in enumerate(self.AccountChain.records(self.historyBase), self.historyBase):
+                self.index_account_history(height, record)
+                
+    @staticmethod
+    def date_to_micros(date):
+        # the creation dates are naive local times
+        if date.tzinfo is not None:
+            date = date.astimezone().replace(tzinfo=None)
+        return to_epoch_micros(date)
+    
+    @with_chain_lock
+    def party_history(self, party, start = None, end = None, cursor = 0, limit = 100):
+        # the accounts of the party created between start and end (both included), as (height, change, balance after),
+        # with the cursor of the next page or None
+        self.ensure_history_index()
+        heights, balances = self.historyIndex.get(self.normalize_party(party), (array('Q'), array('q')))
+        
+        # the creation dates only increase, so the date range is a range of heights
+        first = 0 if start is None else bisect_left(self.creationDates, self.date_to_micros(start))
+        last = len(self.creationDates) if end is None else bisect_right(self.creationDates, self.date_to_micros(end))
+        low = bisect_left(heights, self.historyBase + first)
+        high = bisect_left(heights, self.historyBase + last)
+        
+        begin = low + max(cursor, 0)
+        stop = min(high, begin + max(limit, 0))
+        start_balance = self.history_start_balance(self.normalize_party(party))
+        history = [(heights[i], balances[i] - (balances[i - 1] if i > 0 else start_balance), balances[i])
+                   for i in range(begin, stop)]
+        return history, (stop - low if stop < high else None)
+    
+    @with_chain_lock
+    def balance_at(self, party, date):
+        # the party balance including every account created up to the date, and the chain height at that date,
+        # the balance is None for a date before the checkpoint tip of a pruned chain
+        self.ensure_history_index()
+        micros = self.date_to_micros(date)
+        if self.historyBase > 0 and micros < self.checkpoint.tipCreationDate:
+            return None, None
+        
+        heights, balances = self.historyIndex.get(self.normalize_party(party), (array('Q'), array('q')))
+        height = self.historyBase + bisect_right(self.creationDates, micros)
+        i = bisect_left(heights, height)
+        return (balances[i - 1] if i > 0 else self.history_start_balance(self.normalize_party(party))), height
+        
+    @staticmethod
+    def normalize_party(name):
+        if name is None:
+            return None
+        return name.lower()
+    
+    def apply_to_balance_index(self, lendingRequest, direction = 1, balances = None):
+        # a direction of -1 takes the request back out, `balances` applies the request to another index
+        amount = lendingRequest.amount * direction
+        if balances is None:
+            balances = self.balanceIndex
+        
+        # money left the lender
+        lender = self.normalize_party(lendingRequest.lender)
+        if lender is not None:
+            balances[lender] = balances.get(lender, 0) - amount
+        
+        # money lent to the borrower
+        borrower = self.normalize_party(lendingRequest.borrower)
+        balances[borrower] = balances.get(borrower, 0) + amount
+        
+    def rebuild_balance_index(self, start = 0, balances = None):
+        # recompute the balance index from the accounts after `start` on top of `balances`,
+        # and the pending commitments and hashes from scratch, a pruned chain starts from the checkpoint balances
+        if self.checkpoint is not None and start < self.checkpoint.height and self.AccountChain.base > 0:
+            start, balances = self.checkpoint.height, self.checkpoint.balances
+        self.balanceIndex = dict(balances or {})
+        for record in self.AccountChain.records(start):
+            for request in self.account_requests(record):
+                self.apply_to_balance_index(request)
+            
+        self.pendingCommitted = {}
+        self.pendingHashes = set()
+        self.pendingContents = {}
+        for request in self.pendingRequests:
+            self.commit_pending_amount(request)
+            self.pendingHashes.add(request.requestHash)
+            
+    def commit_pending_amount(self, lendingRequest):
+        lender = self.normalize_party(lendingRequest.lender)
+        if lender is not None:
+            self.pendingCommitted[lender] = self.pendingCommitted.get(lender, 0) + lendingRequest.amount
+        content = self.pending_content(lendingRequest.lender, lendingRequest.borrower, lendingRequest.amount)
+        self.pendingContents[content] = self.pendingContents.get(content, 0) + 1
+        
+    def pending_content(self, lender, borrower, amount):
+        return self.normalize_party(lender), self.normalize_party(borrower), amount
+    
+    @with_chain_lock
+    def is_the_blockchain_valid(self):
+        # only the accounts appended since the last successful check are verified
+        height = len(self.AccountChain)
+        if self.verifiedHeight >= height:
+            return True
+        
+        started = time.perf_counter()
+        start = max(self.verifiedHeight, self.checkpoint_height())
+        accounts = list(self.AccountChain.records(start, height))
+        previous = self.AccountChain.record(start - 1) if start > 0 else None
+        
+        # compare the links and creation dates, then the stored and calculated hash states
+        valid = first_bad_link(accounts, start, previous) is None and first_bad_hash(start, accounts) is None
+        VALIDATION_SECONDS.observe(time.perf_counter() - started, kind="incremental")
+        if not valid:
+            return False
+        
+        self.verifiedHeight = height
         return True
+    
+    def audit_blockchain(self, workers = None):
+        # verify the whole chain from scratch on a pool of processes, returns the first bad height or None
+        started = time.perf_counter()
+        height = len(self.AccountChain)
+        base = self.AccountChain.base
+        first_bad_height = audit_accounts(self.AccountChain.records(base, height), workers, start = base)
         
+        # a pruned chain must still start at the tip of a valid checkpoint
+        if base > 0 and (not self.verify_checkpoint(self.checkpoint) or self.AccountChain.record(base).hashState != self.checkpoint.tipHash):
+            first_bad_height = base
+        VALIDATION_SECONDS.observe(time.perf_counter() - started, kind="audit")
+        self.verifiedHeight = height if first_bad_height is None else min(self.verifiedHeight, first_bad_height)
+        return first_bad_height
+        
+    @with_chain_lock
     def create_new_lending_request(self, lender: str, borrower: str, amount: float):
         
         # the lender cannot be the borrower
@@ -58,10 +685,14 @@ class MoneyLenderBlockChain:
         if amount > self.maxAmountMinable:
             return jsonify({"message": "The lender cannot lend more than the max amount"}), 400
         
-        # the lender cannot lend more than the amount he has
-        if amount > self.calculate_lender_balance(lender):
+        # the lender cannot lend more than the amount he has, including what is already pending
+        if amount > self.calculate_available_balance(lender):
             return jsonify({"message": "The lender cannot lend more than the amount he has"}), 400
         
+        # the same transfer is already pending
+        if self.pending_content(lender, borrower, amount) in self.pendingContents:
+            return jsonify({"message": "duplicate lending request not allowed"}), 400
+        
         # the lender or borrower cannot be blank
         if(lender == "" or borrower == ""):
             return jsonify({"message": "The lender or borrower cannot be blank"}), 400
@@ -72,12 +703,14 @@ class MoneyLenderBlockChain:
         lending_request = LendingRequestM(lender = lender, borrower = borrower, amount = amount)
         lending_request.requestHash = LendingRequest(lending_request).calculate_request_hash()
         
-        for request in self.pendingRequests:
-            if(request.requestHash == lending_request.requestHash):
-                return jsonify({"message": "duplicate lending request not allowed"}), 400
-        
         print("\n New lending request created \n")
+        if self.chainLog is not None:
+            self.chainLog.append_pending(lending_request)
         self.pendingRequests.append(lending_request)
+        self.pendingHashes.add(lending_request.requestHash)
+        self.commit_pending_amount(lending_request)
+        for listener in self.pendingListeners:
+            listener([lending_request])
         
         # return the new lending request
         return jsonify({"lendingRequest": [
@@ -90,83 +723,225 @@ class MoneyLenderBlockChain:
             }
         ]})
         
-    def calculate_lender_balance(self, lender):
-        # calculate the lender balance
-        lender_balance = 0
-        for account in self.AccountChain:
-            lendingRequest = account.lendingRequest
-                
-            # money left the lender
-            if lendingRequest.lender == lender:
-                lender_balance -= lendingRequest.amount
+    @with_chain_lock
+    def create_lending_requests_bulk(self, rows):
+        # validate (lender, borrower, amount) rows in one pass, returns an accept or reject entry per row,
+        # each lender's available balance is read once and then runs down with its accepted rows,
+        # a row repeating a pending request or an accepted row is a duplicate so a retried load is not applied twice
+        available = {}
+        loaded = set()
+        accepted = []
+        report = []
+        for row, (lender, borrower, amount) in enumerate(rows):
+            message = None
+            name = self.normalize_party(lender)
+            content = self.pending_content(lender, borrower, amount)
+            if name not in available:
+                available[name] = self.calculate_available_balance(lender)
+            
+            if lender.lower() == borrower.lower():
+                message = "The lender cannot be the borrower"
+            elif amount > self.maxAmountMinable:
+                message = "The lender cannot lend more than the max amount"
+            elif amount > available[name]:
+                message = "The lender cannot lend more than the amount he has"
+            elif lender == "" or borrower == "":
+                message = "The lender or borrower cannot be blank"
+            elif amount <= 0:
+                message = "The amount must be greater than 0"
+            elif content in self.pendingContents or content in loaded:
+                message = "duplicate lending request not allowed"
                     
-            # money lent to the borrower
-            if lendingRequest.borrower.lower() == lender.lower():
-                lender_balance += lendingRequest.amount
-                  
-        return lender_balance
+            if message is not None:
+                report.append({"row": row, "accepted": False, "message": message})
+                continue
+            
+            lending_request = LendingRequestM(lender = lender, borrower = borrower, amount = amount)
+            lending_request.requestHash = LendingRequest(lending_request).calculate_request_hash()
+            loaded.add(content)
+            available[name] -= amount
+            self.pendingHashes.add(lending_request.requestHash)
+            accepted.append(lending_request)
+            report.append({"row": row, "accepted": True, "requestHash": lending_request.requestHash})
+            
+        print("\n %d lending requests created \n" % len(accepted))
+        if self.chainLog is not None:
+            self.chainLog.append_pending_many(accepted)
+        self.pendingRequests.extend(accepted)
+        for lending_request in accepted:
+            self.commit_pending_amount(lending_request)
+        if len(accepted) > 0:
+            for listener in self.pendingListeners:
+                listener(accepted)
+        return report
+        
+    def calculate_lender_balance(self, lender):
+        # the lender balance on the chain, read from the balance index
+        BALANCE_LOOKUPS.inc(kind="balance")
+        return self.balanceIndex.get(self.normalize_party(lender), 0)
+    
+    def calculate_available_balance(self, lender):
+        # the lender balance less the amounts committed in the pending requests
+        BALANCE_LOOKUPS.inc(kind="available")
+        name = self.normalize_party(lender)
+        return self.balanceIndex.get(name, 0) - self.pendingCommitted.get(name, 0)
             
         
     def process_pending_requests(self):
-        # pro8cess the pending requests
-        print(self.return_last_account().lastAccount)
-        for request in self.pendingRequests:
-            account = AccountM(lendingRequest = request, lastAccount = self.return_last_account().hashState)
-            account.hashState = Account(account).calculate_hash_state()
-            self.AccountChain.append(account)
+        # process the pending requests in batches of up to maxBatchSize, each batch is mined into one account
+        # together with the mining reward, an empty pool still mines the reward
+        # requests created while mining stay pending for the next round
+        with self.miningLock:
+            print(self.return_last_account().lastAccount)
+            pending = list(self.pendingRequests)
+            batches = [pending[i:i + self.maxBatchSize] for i in range(0, len(pending), self.maxBatchSize)]
+            accounts = [self.mine_batch(batch) for batch in batches or [[]]]
+        return accounts
+        
+    def mine_batch(self, batch):
+        # the nonce search runs without the chain lock so the chain stays readable and writable while mining,
+        # the account is only appended if the tip has not moved in the meantime
+        while True:
+            with self.lock:
+                lastAccount = self.AccountChain.tip_hash()
+                batch = self.fundable_requests(batch)
+                
+                # an account adopted from a peer whose clock runs ahead may be dated after now
+                creationDate = max(datetime.now(), from_epoch_micros(self.AccountChain.record(-1).creationDate))
             
-        # clear the pending requests
-        self.pendingRequests = []
+            # mine new account transaction
+            request1 = LendingRequestM(borrower = self.miningOutputOwner, amount = self.maxAmountMinable)
+            request1.requestHash = LendingRequest(request1).calculate_request_hash()
+            
+            # adding the mined lending request and the batch to an account
+            account1 = AccountM(lendingRequest = request1, lendingRequests = batch, lastAccount = lastAccount,
+                                creationDate = creationDate)
+            self.mine_account(account1)
             
-        # mine new account transaction
-        request1 = LendingRequestM(borrower = self.miningOutputOwner, amount = self.maxAmountMinable)
-        request1.requestHash = LendingRequest(request1).calculate_request_hash()
+            with self.lock:
+                if self.AccountChain.tip_hash() != lastAccount:
+                    # an account from a peer may have taken some of the batch or changed the balances in the meantime
+                    continue
+                
+                # add the new account to the chain and take its requests out of the pending pool
+                self.create_new_account(account1)
+                self.remove_pending_requests(batch)
+                for listener in self.blockListeners:
+                    listener(self.AccountChain.record(-1))
+                return account1
+            
+    def fundable_requests(self, batch):
+        # the requests still pending that the balances fund when the batch is replayed in order,
+        # the same replay the peers run on the mined account (see are_transfers_valid)
+        changes = {}
+        return [request for request in batch
+                if request.requestHash in self.pendingHashes and self.replay_transfer(request, changes)]
+    
+    @with_chain_lock
+    def remove_pending_requests(self, requests):
+        if len(requests) == 0:
+            return
+        
+        mined = set(request.requestHash for request in requests)
+        if self.chainLog is not None:
+            self.chainLog.remove_pending(mined, len(self.AccountChain))
+        self.pendingRequests = [request for request in self.pendingRequests if request.requestHash not in mined]
+        self.pendingHashes -= mined
         
-        # adding the mined lending request to an account
-        account1 = AccountM(lendingRequest = request1, lastAccount = self.return_last_account().hashState)
-        account1.hashState = Account(account1).calculate_hash_state()
+        for request in requests:
+            lender = self.normalize_party(request.lender)
+            if lender is not None:
+                self.pendingCommitted[lender] -= request.amount
+                if self.pendingCommitted[lender] == 0:
+                    del self.pendingCommitted[lender]
+            content = self.pending_content(request.lender, request.borrower, request.amount)
+            self.pendingContents[content] -= 1
+            if self.pendingContents[content] == 0:
+                del self.pendingContents[content]
+    
+    def rebuild_group_index(self):
+        self.groupIndex = {}
+        self.groupMembers = {}
+        for group in self.groupLenders:
+            self.index_group(group)
+            
+    def index_group(self, group):
+        name = self.normalize_party(group.name)
+        self.groupIndex[name] = group
+        self.groupMembers[name] = set(self.normalize_party(lender.name) for lender in group.lenders)
         
-        # add the new account to the chain
-        self.AccountChain.append(account1)
+    def find_group(self, name):
+        return self.groupIndex.get(self.normalize_party(name))
     
+    @with_chain_lock
     def create_lender_group(self, name, amount, splitRate_inPercent = 0.25):
         # the lender group must be unique
-        for group in self.groupLenders:
-            if group.name == name:
-                print("\n The lender group must be unique \n")
-                return False
+        if self.find_group(name) is not None:
+            print("\n The lender group must be unique \n")
+            return False
         
         lender_group = GroupLenderM(name = name, totalAmount = amount, splitRate_inPercent = splitRate_inPercent)
         lender_group.groupHash = GroupLender(lender_group).calculate_hash()
         self.groupLenders.append(lender_group)
+        self.index_group(lender_group)
+        self.journal_group(lender_group)
         return True
+    
+    def journal_group(self, group):
+        # the log keeps the latest state of each group
+        if self.chainLog is not None:
+            self.chainLog.append_group(group)
         
+    @with_chain_lock
     def add_lender_to_group(self, lender_name, lenderGroup_name):
-        # the lender must be unique
-        for group in self.groupLenders:
+        # if the group name is not found
+        group = self.find_group(lenderGroup_name)
+        if group is None:
+            return False
+        
+        # if the lender has the right balance to fund the loan and the group is not full
+        if self.calculate_available_balance(lender_name) < group.totalAmount * group.splitRate_inPercent:
+            return False
+        
+        # the lender must be unique in the group
+        members = self.groupMembers[self.normalize_party(group.name)]
+        if self.normalize_party(lender_name) in members:
+            print("\n The lender must be unique \n")
+            return False
             
-            # if the group name is not found
-            if group.name.lower() == lenderGroup_name.lower():
-                
-                # if the lender has the right balance to fund the loan and the group is not full
-                if self.calculate_lender_balance(lender_name) >= group.totalAmount * group.splitRate_inPercent:
-                    
-                    # if the lender is not already in the group
-                    for lender in group.lenders:
-                        if lender.lower() == lender_name.lower():
-                            print("\n The lender must be unique \n")
-                            return False
-                        
-                    lender = Lender(name=lender_name, amount=group.totalAmount*group.splitRate_inPercent)
-                    group.lenders.append(lender)
-                
-                    # add to the pending request list
-                    self.create_new_lending_request(lender.name, group.name, group.totalAmount * group.splitRate_inPercent)
-                
-                    # if payment complete, share the proof of participation with the lenders
-                    if (GroupLender(group).calculate_total_lended() == group.totalAmount):
-                        group.lenders = GroupLender(group).process_lender_stake(group.groupHash)
-                
-                    return True
+        lender = Lender(name=lender_name, amount=group.totalAmount*group.splitRate_inPercent)
+        group.lenders.append(lender)
+        members.add(self.normalize_party(lender_name))
+    
+        # add to the pending request list
+        self.create_new_lending_request(lender.name, group.name, group.totalAmount * group.splitRate_inPercent)
+    
+        # if payment complete, share the proof of participation with the lenders
+        if (GroupLender(group).calculate_total_lended() == group.totalAmount):
+            group_lender = GroupLender(group)
+            group.lenders = group_lender.process_lender_stake(group.groupHash, self.keyPool)
+            group.publicKey = group_lender.publicKey
+    
+        self.journal_group(group)
+        return True
+    
+    def verify_lender_groups(self, names = None):
+        # check the proofs of participation of the named groups, or of every group
+        if names is None:
+            groups = list(self.groupLenders)
+        else:
+            groups = [self.find_group(name) for name in dict.fromkeys(self.normalize_party(name) for name in names)]
         
-        return False
\ No newline at end of file
+        results = []
+        for group in groups:
+            if group is None:
+                continue
+            
+            lenders = GroupLender(group).verify_lender_stake(group.groupHash)
+            results.append({
+                    "name": group.name,
+                    "signed": group.publicKey is not None,
+                    "valid": group.publicKey is not None and all(lenders.values()),
+                    "lenders": lenders
+                })
+        return results
\ No newline at end of file
@@ -0,0 +1,220 @@
+"""_summary_
+    Peer to peer sync between money lender blockchain nodes over http.
+    Nodes register with each other, gossip the accounts they mine and the lending requests they receive,
+    and catch up by fetching only the accounts after the last hash state they share with a peer,
+    in batches of the compact binary block records. Forks are settled by the longest valid chain.
+    A node that has pruned its chain below a checkpoint only serves the accounts from the checkpoint tip up,
+    so it cannot bring up a new node, new nodes catch up from a node that still has the accounts from the genesis account.
+"""
+
+import queue
+import struct
+import threading
+import urllib.parse
+import urllib.request
+
+from chain_log import RECORD_BLOCK, RECORD_PENDING_ADD, frame, scan_records, encode_block, decode_block
+from chain_log import encode_request, decode_request
+
+BINARY_MIMETYPE = "application/octet-stream"
+
+
+def encode_blocks(records):
+    return b''.join(frame(RECORD_BLOCK, encode_block(record)) for record in records)
+
+
+def decode_blocks(data):
+    return [decode_block(data, offset) for record_type, offset, end in scan_records(data, 0, len(data))
+            if record_type == RECORD_BLOCK]
+
+
+def encode_pending(requests):
+    return b''.join(frame(RECORD_PENDING_ADD, encode_request(request)) for request in requests)
+
+
+def decode_pending(data):
+    return [decode_request(data, offset)[0].to_model() for record_type, offset, end in scan_records(data, 0, len(data))
+            if record_type == RECORD_PENDING_ADD]
+
+
+class PeerNode:
+    def __init__(self, blockchain, selfUrl=None, batchSize=500, timeout=5.0, syncInterval=30.0):
+        self.blockchain = blockchain
+        self.selfUrl = selfUrl
+        self.peers = set()
+        self.peersLock = threading.Lock()
+
+        # accounts per catch up request, and the seconds between two catch ups with every peer
+        self.batchSize = batchSize
+        self.timeout = timeout
+        self.syncInterval = syncInterval
+
+        # outgoing gossip is sent from a worker thread so mining and requests never wait on the network
+        self.outbox = queue.Queue()
+        self.threads = []
+        self.stopping = threading.Event()
+        self.failures = {}
+
+        blockchain.blockListeners.append(self.gossip_block)
+        blockchain.pendingListeners.append(self.gossip_pending)
+
+    def start(self):
+        if len(self.threads) == 0:
+            self.threads = [threading.Thread(target=self.send_gossip, name="peer-gossip", daemon=True),
+                            threading.Thread(target=self.sync_periodically, name="peer-sync", daemon=True)]
+            for thread in self.threads:
+                thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def known_peers(self):
+        with self.peersLock:
+            return sorted(self.peers)
+
+    def add_peer(self, url):
+        url = url.rstrip("/")
+        if url == "" or url == self.selfUrl:
+            return False
+        with self.peersLock:
+            if url in self.peers:
+                return False
+            self.peers.add(url)
+        return True
+
+    def request(self, peer, path, params=None, data=None):
+        # returns the response body and headers, raises OSError when the peer cannot be reached
+        url = peer + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        headers = {"Content-Type": BINARY_MIMETYPE}
+        if self.selfUrl is not None:
+            headers["X-Peer"] = self.selfUrl
+        http_request = urllib.request.Request(url, data=data, headers=headers, method="GET" if data is None else "POST")
+        with urllib.request.urlopen(http_request, timeout=self.timeout) as response:
+            return response.read(), response.headers
+
+    def register_with(self, peer):
+        # announce this node to the peer and learn the peers it knows
+        self.add_peer(peer)
+        if self.selfUrl is None:
+            return
+        try:
+            body, headers = self.request(peer, "/peers/register", {"url": self.selfUrl}, b'')
+        except OSError:
+            return
+        for url in body.decode().split():
+            self.add_peer(url)
+
+    def broadcast(self, path, data, exclude=None):
+        for peer in self.known_peers():
+            if peer != exclude:
+                self.outbox.put((peer, path, data))
+
+    def gossip_block(self, record, exclude=None):
+        self.broadcast("/peers/blocks", encode_blocks([record]), exclude)
+
+    def gossip_pending(self, requests, exclude=None):
+        self.broadcast("/peers/pending", encode_pending(requests), exclude)
+
+    def send_gossip(self):
+        while not self.stopping.is_set():
+            try:
+                peer, path, data = self.outbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.request(peer, path, data=data)
+                self.failures.pop(peer, None)
+            except OSError:
+                self.failures[peer] = self.failures.get(peer, 0) + 1
+
+    def sync_periodically(self):
+        while not self.stopping.wait(self.syncInterval):
+            self.sync_all()
+
+    def sync_all(self):
+        return [peer for peer in self.known_peers() if self.sync_with(peer)]
+
+    def sync_with(self, peer):
+        # fetch the accounts after the last hash state shared with the peer, returns True if the chain changed
+        # the batches of a fork are held until they outgrow this chain, the batches after that are appended one by one
+        locator = self.blockchain.block_locator()
+        start = None
+        pending = []
+        changed = False
+        while not self.stopping.is_set():
+            try:
+                body, headers = self.request(peer, "/peers/blocks",
+                                             {"locator": ",".join(locator), "limit": self.batchSize})
+                records = decode_blocks(body)
+            except (OSError, ValueError, struct.error):
+                return changed
+
+            height = int(headers["X-Start-Height"])
+            peer_height = int(headers["X-Chain-Height"])
+            if start is None:
+                start = height
+                if peer_height <= len(self.blockchain.AccountChain):
+                    return False
+                # the peer has pruned the accounts this chain is missing
+                if start > len(self.blockchain.AccountChain):
+                    return False
+            elif height != start + len(pending):
+                # the peer has switched chains in the meantime
+                return changed
+            if len(records) == 0:
+                return changed
+
+            pending += records
+            if start + len(pending) > len(self.blockchain.AccountChain):
+                if not self.blockchain.adopt_blocks(start, pending):
+                    return changed
+                changed = True
+                start += len(pending)
+                pending = []
+
+            if start + len(pending) >= peer_height:
+                return changed
+            locator = [records[-1].hashState.hex()]
+        return changed
+
+    def receive_blocks(self, data, sender=None):
+        # an account gossiped by a peer: append it when it extends this chain or a longer fork of it,
+        # catch up with the sender when its parent is unknown here
+        if sender is not None:
+            sender = sender.rstrip("/")
+        records = decode_blocks(data)
+        if len(records) == 0:
+            return False
+        if self.blockchain.find_block_height(records[-1].hashState.hex()) is not None:
+            return False
+
+        if records[0].lastAccount is None:
+            start = 0
+        else:
+            parent = self.blockchain.find_block_height(records[0].lastAccount.hex())
+            if parent is None:
+                if sender is not None:
+                    self.add_peer(sender)
+                    threading.Thread(target=self.sync_with, args=(sender,), daemon=True).start()
+                return False
+            start = parent + 1
+
+        if not self.blockchain.adopt_blocks(start, records):
+            return False
+        for record in records:
+            self.gossip_block(record, exclude=sender)
+        return True
+
+    def receive_pending(self, data, sender=None):
+        if sender is not None:
+            sender = sender.rstrip("/")
+        accepted = self.blockchain.accept_pending_requests(decode_pending(data))
+        if len(accepted) > 0:
+            self.gossip_pending(accepted, exclude=sender)
+        return accepted
@@ -0,0 +1,367 @@
+"""_summary_
+    Regression tests for the consensus and persistence rules of the money lender blockchain:
+    fork adoption and the accounts a node must reject, the log replay and truncation, the checkpoint restart
+    and the IPC authentication.
+
+    python -m pytest -q test_money_lender_blockchain.py
+"""
+
+import threading
+from datetime import datetime, timedelta
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+import pytest
+import rsa
+from flask import Flask
+
+import chain_log
+from chain_ipc import parse_address
+from chain_store import BlockRecord
+from checkpoints import Checkpoint, save_checkpoint, NODE_KEY_BITS
+from lending_requests import LendingRequestM, LendingRequest, AccountM
+from money_lender_blockchain import MoneyLenderBlockChain
+
+
+@pytest.fixture(autouse=True)
+def app_context():
+    # create_new_lending_request answers with flask responses
+    with Flask(__name__).app_context():
+        yield
+
+
+@pytest.fixture(scope="module")
+def node_key():
+    # one node key for every test, a 2048 bit key takes seconds to generate
+    public_key, private_key = rsa.newkeys(NODE_KEY_BITS)
+    return private_key.save_pkcs1()
+
+
+def open_chain(path=None):
+    chain = MoneyLenderBlockChain(logPath=str(path) if path is not None else None)
+    chain.miningDifficulty = 0
+    return chain
+
+
+@pytest.fixture
+def chains():
+    # every chain opened by a test is closed with it, unless the test closed it
+    opened = []
+
+    def make(path=None, key=None):
+        if path is not None and key is not None and not (path.parent / (path.name + ".key")).exists():
+            (path.parent / (path.name + ".key")).write_bytes(key)
+        chain = open_chain(path)
+        opened.append(chain)
+        return chain
+    yield make
+    for chain in opened:
+        if chain.chainLog is None or chain.chainLog.lockFile is not None:
+            chain.close()
+
+
+def follower(chains, chain, height=1):
+    # a node sharing the accounts of `chain` below `height`
+    peer = chains()
+    peer.truncate_chain(0)
+    for record in chain.AccountChain.records(0, height):
+        peer.create_new_account(record)
+    return peer
+
+
+def request(lender, borrower, amount):
+    lending_request = LendingRequestM(lender=lender, borrower=borrower, amount=amount)
+    lending_request.requestHash = LendingRequest(lending_request).calculate_request_hash()
+    return lending_request
+
+
+def block(chain, requests, lastAccount, creationDate=None):
+    # a batched account mined at the chain difficulty, the first request is the mining reward
+    account = AccountM(lendingRequest=requests[0], lendingRequests=requests[1:], lastAccount=lastAccount,
+                       creationDate=creationDate or datetime.now())
+    chain.mine_account(account)
+    return BlockRecord.from_model(account)
+
+
+def reward():
+    return request(None, "Femi", 100)
+
+
+def test_longer_fork_is_adopted_and_orphaned_requests_return_to_the_pool(chains):
+    chain = chains()
+    peer = follower(chains, chain)
+    chain.create_new_lending_request("Femi", "Ann", 30)
+    chain.process_pending_requests()
+
+    peer.process_pending_requests()
+    peer.process_pending_requests()
+    assert chain.adopt_blocks(1, list(peer.AccountChain.records(1)))
+
+    assert chain.AccountChain.tip_hash() == peer.AccountChain.tip_hash()
+    assert chain.calculate_lender_balance("ann") == 0
+    assert [(pending.lender, pending.borrower) for pending in chain.pendingRequests] == [("Femi", "Ann")]
+    assert chain.is_the_blockchain_valid()
+
+
+def test_shorter_fork_is_not_adopted(chains):
+    chain = chains()
+    peer = follower(chains, chain)
+    chain.process_pending_requests()
+    chain.process_pending_requests()
+    peer.process_pending_requests()
+    assert not chain.adopt_blocks(1, list(peer.AccountChain.records(1)))
+
+
+@pytest.mark.parametrize("requests", [
+        pytest.param(lambda: [request(None, "Mallory", 10 ** 9)], id="reward to another party"),
+        pytest.param(lambda: [request(None, "Femi", 101)], id="inflated reward"),
+        pytest.param(lambda: [reward(), request(None, "Femi", 100)], id="two rewards"),
+        pytest.param(lambda: [request("Femi", "Bob", 10)], id="no reward"),
+        pytest.param(lambda: [reward(), request("Femi", "Bob", 100), request("Femi", "Bob", 101)], id="overdraw"),
+        pytest.param(lambda: [reward(), request("Femi", "Bob", 150)], id="over the max amount"),
+        pytest.param(lambda: [reward(), request("Femi", "Femi", 10)], id="lender is the borrower"),
+    ])
+def test_account_breaking_the_transfer_rules_is_rejected(chains, requests):
+    chain = chains()
+    assert not chain.adopt_blocks(1, [block(chain, requests(), chain.AccountChain.tip_hash())])
+    assert len(chain.AccountChain) == 1
+
+
+def test_request_repeated_in_an_account_is_rejected(chains):
+    # [a, b, b] has the same merkle root as [a, b] with its odd leaf paired with itself
+    chain = chains()
+    transfer = request("Femi", "Bob", 1)
+    assert not chain.adopt_blocks(1, [block(chain, [reward(), transfer, transfer], chain.AccountChain.tip_hash())])
+
+
+def test_replayed_request_is_rejected(chains):
+    chain = chains()
+    transfer = request("Femi", "Bob", 50)
+    first = block(chain, [reward(), transfer], chain.AccountChain.tip_hash())
+    assert chain.adopt_blocks(1, [first])
+    assert not chain.adopt_blocks(2, [block(chain, [reward(), transfer], first.hashState.hex())])
+    assert chain.calculate_lender_balance("bob") == 50
+
+
+def test_account_dated_ahead_of_the_clock_is_rejected(chains):
+    chain = chains()
+    ahead = block(chain, [reward()], chain.AccountChain.tip_hash(), datetime.now() + timedelta(hours=1))
+    assert not chain.adopt_blocks(1, [ahead])
+
+
+def test_account_mined_after_a_peer_account_dated_ahead_follows_it(chains):
+    chain = chains()
+    ahead = block(chain, [reward()], chain.AccountChain.tip_hash(), datetime.now() + timedelta(seconds=2))
+    assert chain.adopt_blocks(1, [ahead])
+    chain.process_pending_requests()
+    assert chain.is_the_blockchain_valid()
+
+
+def test_pending_pool_is_settled_after_a_reorg(chains):
+    # Ann's pending transfer was funded by an account the fork orphans, mining it first would overdraw Ann
+    chain = chains()
+    peer = follower(chains, chain)
+    chain.create_new_lending_request("Femi", "Ann", 50)
+    chain.process_pending_requests()
+    chain.create_new_lending_request("Ann", "Bob", 50)
+
+    peer.process_pending_requests()
+    peer.process_pending_requests()
+    assert chain.adopt_blocks(1, list(peer.AccountChain.records(1)))
+    assert [(pending.lender, pending.borrower) for pending in chain.pendingRequests] == [("Femi", "Ann")]
+    assert chain.calculate_available_balance("ann") == 0
+
+    chain.process_pending_requests()
+    assert peer.adopt_blocks(1, list(chain.AccountChain.records(1)))
+
+
+def test_duplicate_pending_request_is_rejected(chains):
+    chain = chains()
+    rows = [("Femi", "Ann", 5), ("Femi", "ann", 5)]
+    assert [row["accepted"] for row in chain.create_lending_requests_bulk(rows)] == [True, False]
+    assert chain.create_new_lending_request("Femi", "Ann", 5)[1] == 400
+    chain.process_pending_requests()
+    assert [row["accepted"] for row in chain.create_lending_requests_bulk(rows)] == [True, False]
+
+
+def test_log_replay_restores_the_chain_and_the_pending_pool(chains, tmp_path):
+    path = tmp_path / "chain.log"
+    chain = chains(path)
+    chain.create_new_lending_request("Femi", "Ann", 30)
+    chain.process_pending_requests()
+    chain.create_new_lending_request("Ann", "Bob", 10)
+    tip, balances = chain.AccountChain.tip_hash(), dict(chain.balanceIndex)
+    chain.close()
+
+    restarted = chains(path)
+    assert restarted.AccountChain.tip_hash() == tip
+    assert restarted.balanceIndex == balances
+    assert [(pending.lender, pending.borrower) for pending in restarted.pendingRequests] == [("Ann", "Bob")]
+    assert restarted.audit_blockchain(1) is None
+
+
+def test_log_is_locked_to_one_chain(chains, tmp_path):
+    chains(tmp_path / "chain.log")
+    with pytest.raises(ValueError):
+        open_chain(tmp_path / "chain.log")
+
+
+def test_requests_mined_before_a_crash_are_not_pending_after_it(chains, tmp_path):
+    # the account is logged and the node stops before the removal of its requests is journaled
+    path = tmp_path / "chain.log"
+    chain = chains(path)
+    chain.create_new_lending_request("Femi", "Bob", 30)
+    chain.remove_pending_requests = lambda requests: None
+    chain.process_pending_requests()
+    chain.chainLog.close()
+
+    restarted = chains(path)
+    assert restarted.pendingRequests == []
+    assert restarted.calculate_available_balance("femi") == 170
+
+
+def test_fork_truncates_the_log(chains, tmp_path):
+    path = tmp_path / "chain.log"
+    chain = chains(path)
+    for i in range(3):
+        chain.process_pending_requests()
+    chain.close()
+
+    chain = chains(path)
+    peer = follower(chains, chain)
+    for i in range(5):
+        peer.process_pending_requests()
+    assert chain.adopt_blocks(1, list(peer.AccountChain.records(1)))
+    chain.close()
+
+    restarted = chains(path)
+    assert restarted.AccountChain.tip_hash() == peer.AccountChain.tip_hash()
+    assert len(restarted.AccountChain) == 6
+    assert restarted.audit_blockchain(1) is None
+
+
+@pytest.fixture
+def windows_file_rules(monkeypatch):
+    # like Windows, a log with a mapped view cannot be truncated or replaced
+    logs = []
+    truncate, replace = chain_log.ChainLog.truncate, chain_log.os.replace
+
+    def check(path):
+        for log in logs:
+            assert not (path == log.path and log.blocks is not None and log.blocks.buffer is not None)
+
+    def guarded_truncate(path, size):
+        check(path)
+        truncate(path, size)
+
+    def guarded_replace(source, destination):
+        check(destination)
+        replace(source, destination)
+    monkeypatch.setattr(chain_log.ChainLog, "truncate", staticmethod(guarded_truncate))
+    monkeypatch.setattr(chain_log.os, "replace", guarded_replace)
+    return logs
+
+
+def test_fork_truncates_a_pruned_log(chains, tmp_path, node_key, windows_file_rules):
+    path = tmp_path / "chain.log"
+    chain = chains(path, node_key)
+    windows_file_rules.append(chain.chainLog)
+    for i in range(3):
+        chain.process_pending_requests()
+    peer = follower(chains, chain, len(chain.AccountChain))
+    chain.create_checkpoint()
+    for i in range(3):
+        chain.process_pending_requests()
+    chain.close()
+
+    # the peer forks one account above the checkpoint of the restarted chain
+    chain = chains(path)
+    windows_file_rules.append(chain.chainLog)
+    start = chain.checkpoint.height + 1
+    for record in chain.AccountChain.records(len(peer.AccountChain), start):
+        peer.create_new_account(record)
+    for i in range(5):
+        peer.process_pending_requests()
+    assert chain.adopt_blocks(start, list(peer.AccountChain.records(start)))
+    chain.close()
+
+    restarted = chains(path)
+    assert restarted.AccountChain.tip_hash() == peer.AccountChain.tip_hash()
+    assert len(restarted.AccountChain) == len(peer.AccountChain)
+    assert restarted.audit_blockchain(1) is None
+
+
+def test_pruned_chain_restarts_from_its_checkpoint(chains, tmp_path, node_key):
+    path = tmp_path / "chain.log"
+    chain = chains(path, node_key)
+    chain.create_new_lending_request("Femi", "Ann", 30)
+    for i in range(4):
+        chain.process_pending_requests()
+    checkpoint = chain.create_checkpoint()
+    chain.process_pending_requests()
+    height, balances = len(chain.AccountChain), dict(chain.balanceIndex)
+    chain.close()
+
+    restarted = chains(path)
+    assert restarted.AccountChain.base == checkpoint.base
+    assert len(restarted.AccountChain) == height
+    assert restarted.balanceIndex == balances
+    assert restarted.audit_blockchain(1) is None
+
+
+def test_checkpoint_taken_without_pruning_restarts(chains, tmp_path, node_key):
+    # the log starts at the genesis account or an older checkpoint tip, not at the tip of the latest checkpoint
+    path = tmp_path / "chain.log"
+    chain = chains(path, node_key)
+    for i in range(3):
+        chain.process_pending_requests()
+    chain.create_checkpoint()
+    for i in range(5):
+        chain.process_pending_requests()
+    checkpoint = chain.create_checkpoint(prune=False)
+    height = len(chain.AccountChain)
+    chain.close()
+
+    restarted = chains(path)
+    assert restarted.AccountChain.base == checkpoint.base
+    assert len(restarted.AccountChain) == height
+    assert restarted.audit_blockchain(1) is None
+
+
+def test_checkpoint_signed_with_another_key_is_rejected(chains, tmp_path, node_key):
+    path = tmp_path / "chain.log"
+    chain = chains(path, node_key)
+    for i in range(3):
+        chain.process_pending_requests()
+    checkpoint = chain.create_checkpoint()
+    chain.close()
+
+    # forged balances signed with the forger's own key, which the checkpoint carries
+    public_key, private_key = rsa.newkeys(512)
+    forged = Checkpoint(checkpoint.height, checkpoint.tipHash, checkpoint.tipCreationDate, {"mallory": 10 ** 9})
+    save_checkpoint(str(path) + ".checkpoint", forged.sign(private_key, public_key))
+    with pytest.raises(ValueError):
+        open_chain(path)
+
+
+def test_chain_owner_only_listens_on_the_loopback():
+    assert parse_address("127.0.0.1:5050") == ("127.0.0.1", 5050)
+    with pytest.raises(ValueError):
+        parse_address("0.0.0.0:5050")
+
+
+def test_chain_owner_rejects_a_client_with_another_key():
+    listener = Listener(("127.0.0.1", 0), authkey=b"owner key")
+
+    def accept():
+        try:
+            listener.accept()
+        except AuthenticationError:
+            pass
+    accepting = threading.Thread(target=accept, daemon=True)
+    accepting.start()
+    try:
+        with pytest.raises(AuthenticationError):
+            Client(listener.address, authkey=b"another key")
+    finally:
+        accepting.join(5)
+        listener.close()